@@ -1,7 +1,34 @@
+import argparse
+import asyncio
+import atexit
+import bisect
+import inspect
+import multiprocessing
+import os
+import re
+import signal
 import socket
+import struct
+import sys
+import tempfile
 import threading
+import time
+import types
+from contextlib import contextmanager
 from datetime import datetime
 
+import metrics
+from bus import Broker, BusClient
+from capture import CaptureWriter
+
+from connection import OUTBOUND_QUEUE_SIZE, AsyncConnection, ClientConnection, StartCompression, encode_notice
+from limits import make_bucket
+from protocol import (BINARY_ACK, COMPRESS_ACK, COMPRESS_THRESHOLD, INTERN_ROOM, INTERN_USER, OP_SERVER_TEXT, RECV_SIZE, BinaryFrameBuffer, FrameTooLarge,
+                      Interner, decode_command, encode_frame, encode_intern, encode_message, encode_reply, split_tag)
+from presence import RosterCache, Subscriptions
+from search import MAX_INDEXED, SearchIndex
+from storage import MAX_SEGMENTS, Message, MessageLog, RingLog
+
 # Server setup
 SERVER_ADDRESS = '127.0.0.1'
 SERVER_PORT = 404
@@ -9,40 +36,316 @@ SERVER_PORT = 404
 # Storage for active connections and messages
 connected_users = {}
 
-message_board = []
-chat_rooms = {f"Room{i + 1}": {"participants": {}, "logs": []} for i in range(5)}
+# Without --data-dir messages live in fixed-size ring buffers holding the newest ones
+BOARD_CAPACITY = 5
+ROOM_CAPACITY = 1000
+
+# Rooms that exist from the start; more are added with !createroom
+DEFAULT_ROOMS = [f"Room{i + 1}" for i in range(5)]
+# Room names double as directory names under --data-dir
+ROOM_NAME = re.compile(r"[A-Za-z0-9_-]{1,32}")
+ROOMS_PAGE_SIZE = 50
+
+# !history returns this many messages unless asked for a different number, up to the maximum,
+# reading the log this many messages per lock acquisition
+HISTORY_LIMIT = 100
+MAX_HISTORY_LIMIT = 10000
+HISTORY_BATCH = 64
+# Seconds an empty room stays loaded before it is evicted; 0 keeps every room loaded
+ROOM_IDLE_SECONDS = 300
+
+# Admission control: most open connections in this process and registered users across the
+# server; 0 is unlimited
+MAX_CONNECTIONS = 10000
+MAX_USERS = 10000
+# Token-bucket limits on !send and !roommsg in messages per second, with bursts of up to
+# *_BURST. The user limit covers each client; the room limit is shared by everyone posting
+# to one room, the public board included. A rate of 0 turns a limit off.
+USER_RATE = 5.0
+USER_BURST = 20
+ROOM_RATE = 0.0
+ROOM_BURST = 100
+# Disconnect a client once this many broadcasts are waiting for it; 0 only drops them
+HIGH_WATER = 0
+
+message_board = RingLog(BOARD_CAPACITY)
+# Search index over message_board, updated as each message is stored
+board_index = SearchIndex()
+# Sorted names of every room, loaded or not
+room_index = sorted(DEFAULT_ROOMS)
+# State of the rooms currently in memory, allocated on first use by load_room()
+chat_rooms = {}
+# With --data-dir, evicted rooms keep their logs on disk here. Without it their history is
+# dropped and only the next message id is remembered, so ids are still never reused.
+rooms_dir = None
+room_segments = MAX_SEGMENTS
+evicted_next_ids = {}
+
+# With --capture, records every connection's commands for replay.py
+capture = None
+
+# Connections currently open in this process, and the public board's rate limit
+open_connections = 0
+connections_lock = threading.Lock()
+board_bucket = None
 
-# Lock for thread safety
-thread_lock = threading.Lock()
+# Locks for thread safety, one per shard of state:
+#   registry_lock   guards connected_users
+#   board_lock      guards message_board and board_index
+#   rooms_lock      guards room_index, evicted_next_ids and adding or removing chat_rooms entries
+#   room["lock"]    guards that room's participants, logs and search index
+# Handlers hold at most one of these at a time and never call out to other handlers while
+# holding one. If a future change must nest them, acquire in the order
+# registry_lock -> room["lock"] (one room at a time) -> board_lock. rooms_lock is never held
+# together with any other lock.
+#
+# connected_users and every room's participants dict are copy-on-write: writers build a new
+# dict under the lock and swap it in, so a reference read without the lock is a stable
+# snapshot that broadcasts can iterate while other threads keep joining and leaving.
+registry_lock = threading.Lock()
+board_lock = threading.Lock()
+rooms_lock = threading.Lock()
 
-def client_handler(user_conn, client_addr):
+# Set by run_async_server; handlers on the event loop must not block waiting for the bus
+serving_async = False
+
+# With --workers, the connection to the broker shared by all worker processes, plus
+# copy-on-write mirrors (guarded by registry_lock) of users and room members on other workers
+bus = None
+remote_users = frozenset()
+remote_members = {}
+
+# Rendered !active and !roomusers lists, and connections subscribed to join/leave updates;
+# scope None is the whole server, any other scope is a room name
+rosters = RosterCache()
+presence = Subscriptions()
+
+# Numeric ids that binary-protocol clients use for users and rooms; room id 0 is the public board
+user_ids = Interner()
+room_ids = Interner()
+
+def client_handler(client_socket, client_addr):
     """Manages interaction with a single client."""
-    user_id = None
+    user_conn = ClientConnection(client_socket, OUTBOUND_QUEUE_SIZE, HIGH_WATER)
+    if not track_connection(1):
+        user_conn.send(f"Server is full ({MAX_CONNECTIONS} connections). Try again later.\n".encode())
+        user_conn.close()
+        return
+    user_conn.send_bucket = make_bucket(USER_RATE, USER_BURST)
+    if capture:
+        user_conn.capture_id = capture.open()
+    session = types.SimpleNamespace(user_id=None, disconnect=False)
     try:
-        user_conn.sendall("Welcome to the Interactive Bulletin Board! Use '!register [username]' to join.\nUse !help for additional help.\n".encode())
+        user_conn.send("Welcome to the Interactive Bulletin Board! Use '!register [username]' to join.\nUse !help for additional help.\n".encode())
         while True:
-            data = user_conn.recv(1024).decode().strip()
+            data = user_conn.recv(RECV_SIZE)
             if not data:
                 break
 
-            result, user_id = process_client_input(data, user_id, user_conn)
-            if result == "DISCONNECT":
+            for reply in iter_replies(process_frames(user_conn.frames.feed(data), session, user_conn)):
+                user_conn.send(reply, block=True)
+            if session.disconnect:
                 break
-            user_conn.sendall(result.encode())
+    except FrameTooLarge as e:
+        user_conn.send(encode_notice(user_conn, f"{e} Closing connection.\n"), block=True)
     except Exception as e:
         print(f"Error communicating with {client_addr}: {e}")
     finally:
-        if user_id:
-            with thread_lock:
-                connected_users.pop(user_id, None)
-                for room in chat_rooms.values():
-                    room["participants"].pop(user_id, None)
-            global_message(f"{user_id} has left the server.\n", None)
+        remove_user(session.user_id, user_conn)
+        user_conn.close()
+        track_connection(-1)
+        if capture:
+            capture.closed(user_conn.capture_id)
+
+async def async_client_handler(reader, writer):
+    """Manages interaction with a single client on the event loop."""
+    user_conn = AsyncConnection(writer, OUTBOUND_QUEUE_SIZE, HIGH_WATER)
+    if not track_connection(1):
+        user_conn.send(f"Server is full ({MAX_CONNECTIONS} connections). Try again later.\n".encode())
         user_conn.close()
+        return
+    user_conn.send_bucket = make_bucket(USER_RATE, USER_BURST)
+    if capture:
+        user_conn.capture_id = capture.open()
+    client_addr = writer.get_extra_info("peername")
+    session = types.SimpleNamespace(user_id=None, disconnect=False)
+    try:
+        user_conn.send("Welcome to the Interactive Bulletin Board! Use '!register [username]' to join.\nUse !help for additional help.\n".encode())
+        while True:
+            data = await reader.read(RECV_SIZE)
+            if not data:
+                break
+
+            for reply in iter_replies(process_frames(user_conn.frames.feed(data), session, user_conn)):
+                if inspect.iscoroutine(reply):
+                    reply = await reply
+                await user_conn.reply(reply)
+            if session.disconnect:
+                break
+    except FrameTooLarge as e:
+        await user_conn.reply(encode_notice(user_conn, f"{e} Closing connection.\n"))
+    except Exception as e:
+        print(f"Error communicating with {client_addr}: {e}")
+    finally:
+        remove_user(session.user_id, user_conn)
+        user_conn.close()
+        track_connection(-1)
+        if capture:
+            capture.closed(user_conn.capture_id)
+
+def track_connection(change):
+    """Count a connection opening (1) or closing (-1). An opening one past MAX_CONNECTIONS is refused with False."""
+    global open_connections
+    with connections_lock:
+        if change > 0 and MAX_CONNECTIONS and open_connections >= MAX_CONNECTIONS:
+            if metrics.enabled:
+                metrics.admissions_refused.labels("connections").inc()
+            return False
+        open_connections += change
+    if metrics.enabled:
+        metrics.connections_open.inc(change)
+        if change > 0:
+            metrics.connections_total.inc()
+    return True
+
+def rate_limited(user_conn, target_bucket):
+    """Spend a token from the sender's bucket and then the target's; return the refusal to reply with, if any.
+
+    A message refused by the target's limit gets the sender's token back, so only messages
+    that go out count against the sender.
+    """
+    spent = []
+    for bucket, scope, rate, burst in ((user_conn.send_bucket, "user", USER_RATE, USER_BURST),
+                                       (target_bucket, "room", ROOM_RATE, ROOM_BURST)):
+        if bucket is None:
+            continue
+        wait = bucket.take()
+        if not wait:
+            spent.append(bucket)
+            continue
+        for earlier in spent:
+            earlier.refund()
+        if metrics.enabled:
+            metrics.rate_limited.labels(scope).inc()
+        return f"Rate limit exceeded: at most {rate:g} messages per second per {scope}, in bursts of up to {burst}. Try again in {wait:.1f}s.\n"
+    return None
+
+def process_frames(frame_list, session, user_conn):
+    """Run the commands parsed from one read, yielding each reply as soon as its command finishes.
+
+    The caller queues every reply before the next command runs, so a client never sees the
+    broadcasts caused by one command ahead of the reply to the command before it; the
+    writer still joins whatever is queued into one write. Items are reply buffers,
+    StartCompression markers and generators for streamed replies. session.user_id and
+    session.disconnect are updated as commands run.
+    """
+    for frame in frame_list:
+        if isinstance(frame, tuple):
+            # Binary frames arrive as (request id, opcode, payload) and skip text parsing.
+            tag, opcode, payload = frame
+            try:
+                command = decode_command(opcode, payload, room_ids)
+            except (struct.error, UnicodeDecodeError):
+                yield encode_frame(OP_SERVER_TEXT, tag, b"Malformed binary command.\n")
+                continue
+        else:
+            tag, command = split_tag(frame)
+        if capture:
+            capture.command(user_conn.capture_id, command if isinstance(command, str) else " ".join(command))
+        result, session.user_id = process_client_input(command, session.user_id, user_conn)
+        if inspect.iscoroutine(result):
+            # Only produced on the event loop; the handler awaits it before the next command runs.
+            yield finish_command(result, tag, isinstance(frame, tuple), session, user_conn)
+            continue
+        if result == "DISCONNECT":
+            session.disconnect = True
+            return
+        if isinstance(result, StartCompression):
+            # The acknowledgement is the last plain output; the writer compresses what follows.
+            ack = f"{COMPRESS_ACK}\n".encode()
+            result.ack = encode_frame(OP_SERVER_TEXT, tag, ack) if isinstance(frame, tuple) else ack
+            yield result
+        elif isinstance(result, types.GeneratorType):
+            yield encode_stream(tag, result, isinstance(frame, tuple))
+        elif isinstance(frame, tuple):
+            yield binary_reply(tag, result, user_conn)
+        elif isinstance(result, Message):
+            yield encode_reply(tag, format_message(result).encode())
+        else:
+            yield encode_reply(tag, result.encode())
+
+async def finish_command(pending, tag, binary, session, user_conn):
+    """Wait for a command that had to await the bus, then encode its text reply."""
+    result, session.user_id = await pending
+    return binary_reply(tag, result, user_conn) if binary else encode_reply(tag, result.encode())
+
+def iter_replies(replies):
+    """Flatten process_frames output, pulling streamed replies one chunk at a time.
+
+    Connections queue each chunk with a blocking put, so a stream only advances as fast as
+    the client reads it.
+    """
+    for reply in replies:
+        if isinstance(reply, types.GeneratorType):
+            yield from reply
+        else:
+            yield reply
+
+def encode_stream(tag, parts, binary):
+    """Encode a streamed reply made of text lines and batches of messages, one chunk per part.
+
+    A tagged text command gets one tagged block per chunk; binary clients get one message
+    frame per message, each carrying the request id.
+    """
+    announced = set()
+    for part in parts:
+        if isinstance(part, str):
+            yield encode_frame(OP_SERVER_TEXT, tag, part.encode()) if binary else encode_reply(tag, part.encode())
+        elif binary:
+            frames = []
+            for msg in part:
+                author = user_ids.id_for(msg.user)
+                if author not in announced:
+                    announced.add(author)
+                    frames.append(encode_intern(INTERN_USER, author, msg.user))
+                frames.append(encode_message(0, msg, author, tag))
+            yield b"".join(frames)
+        elif part:
+            yield encode_reply(tag, "".join(format_message(msg) for msg in part).encode())
+
+def binary_reply(req, result, user_conn):
+    """Encode a handler result for a binary connection; retrieved messages go out as message frames."""
+    if not isinstance(result, Message):
+        return encode_frame(OP_SERVER_TEXT, req, result.encode())
+    author = user_ids.id_for(result.user)
+    frame = encode_message(0, result, author, req)
+    if (INTERN_USER, author) in user_conn.interned:
+        return frame
+    # Not marked as announced: a broadcast could overtake this reply, so fan-out announces it again.
+    return encode_intern(INTERN_USER, author, result.user) + frame
+
+def remove_user(user_id, user_conn):
+    """Drop a disconnected client from the rooms it joined and, if registered, the registry, then tell everyone."""
+    global connected_users
+    for scope in user_conn.subscriptions:
+        presence.remove(scope, user_conn)
+    for room_name in user_conn.rooms:
+        with locked_room(room_name) as room:
+            if room and user_id in room["participants"]:
+                room["participants"] = {user: conn for user, conn in room["participants"].items() if user != user_id}
+        presence_changed(room_name, user_id, False)
+    if not user_id:
+        return
+    with registry_lock:
+        connected_users = {user: conn for user, conn in connected_users.items() if user != user_id}
+    presence_changed(None, user_id, False)
+    if bus:
+        bus.release(user_id)
+    publish({"op": "global", "text": f"{user_id} has left the server.\n", "exclude": None})
 
 def process_client_input(input_cmd, user_id, user_conn):
     """Handles parsing and executing client commands."""
-    tokens = input_cmd.split()
+    tokens = input_cmd.split() if isinstance(input_cmd, str) else input_cmd
     if not tokens:
         return "Invalid command. Use '!help' for a list of available commands.\n", user_id
 
@@ -54,21 +357,38 @@ def process_client_input(input_cmd, user_id, user_conn):
         "!retrieve": get_message,
         "!active": list_active_users,
         "!rooms": show_rooms,
+        "!createroom": create_room,
         "!joinroom": join_room,
         "!roommsg": send_room_message,
         "!roomretrieve": retrieve_room_message,
+        "!search": search_messages,
+        "!history": show_history,
         "!roomusers": room_user_list,
+        "!presence": subscribe_presence,
         "!leaveroom": exit_room,
+        "!stats": show_stats,
+        "!binary": enable_binary,
+        "!compress": enable_compression,
         "!quit": disconnect_user,
     }
 
     if command not in commands:
         return "Unrecognized command. Use '!help' for assistance.\n", user_id
 
+    if not metrics.enabled:
+        try:
+            return commands[command](tokens, user_id, user_conn)
+        except Exception as err:
+            return f"Error processing command: {err}\n", user_id
+
+    started = time.perf_counter()
     try:
         return commands[command](tokens, user_id, user_conn)
     except Exception as err:
         return f"Error processing command: {err}\n", user_id
+    finally:
+        metrics.command_seconds.labels(command).observe(time.perf_counter() - started)
+        metrics.commands_total.labels(command).inc()
 
 # Command Handlers
 def register_user(tokens, user_id, user_conn):
@@ -78,35 +398,72 @@ def register_user(tokens, user_id, user_conn):
         return "Usage: !register [username]\n", user_id
 
     new_user = tokens[1]
-    with thread_lock:
+    # With workers, other processes may be registering the same name right now, so the
+    # broker decides. Its reply arrives on the bus thread, which also needs registry_lock,
+    # so the claim must happen before taking the lock.
+    if bus and new_user in remote_users:
+        return "Username is taken. Please choose another.\n", user_id
+    if bus and serving_async:
+        # The event loop must keep serving other clients during the round trip.
+        return claim_and_add_user(new_user, user_conn), user_id
+    if bus and not bus.claim(new_user):
+        return "Username is taken. Please choose another.\n", user_id
+    return add_user(new_user, user_conn)
+
+async def claim_and_add_user(new_user, user_conn):
+    if not await bus.claim_async(new_user):
+        return "Username is taken. Please choose another.\n", None
+    return add_user(new_user, user_conn)
+
+def add_user(new_user, user_conn):
+    """Register a name this worker holds the claim for; returns the reply and the new user id."""
+    global connected_users
+    with registry_lock:
         if new_user in connected_users:
-            return "Username is taken. Please choose another.\n", user_id
-        connected_users[new_user] = user_conn
+            return "Username is taken. Please choose another.\n", None
+        full = MAX_USERS and len(connected_users) + len(remote_users) >= MAX_USERS
+        if not full:
+            connected_users = {**connected_users, new_user: user_conn}
+    if full:
+        if bus:
+            bus.release(new_user)
+        if metrics.enabled:
+            metrics.admissions_refused.labels("users").inc()
+        return f"The server is at its limit of {MAX_USERS} registered users. Try again later.\n", None
+    presence_changed(None, new_user, True)
 
-    global_message(f"{new_user} joined the server!\n", new_user)
+    publish({"op": "global", "text": f"{new_user} joined the server!\n", "exclude": new_user})
     return f"Welcome to the server, {new_user}!\n", new_user
 
 def disconnect_user(tokens, user_id, user_conn):
     return "DISCONNECT", user_id
 
+def enable_binary(tokens, user_id, user_conn):
+    if user_conn.binary:
+        return "Binary protocol is already enabled.\n", user_id
+    # The acknowledgement is the last text this connection receives; from here on both
+    # directions use binary frames.
+    user_conn.binary = True
+    user_conn.frames = BinaryFrameBuffer(user_conn.frames.buffer)
+    return f"{BINARY_ACK}\n", user_id
+
+def enable_compression(tokens, user_id, user_conn):
+    if user_conn.compression_requested:
+        return "Compression is already enabled.\n", user_id
+    user_conn.compression_requested = True
+    return StartCompression(COMPRESS_THRESHOLD), user_id
+
 def send_message(tokens, user_id, user_conn):
     if not user_id:
         return "Register first with '!register [username]'.\n", user_id
     if len(tokens) < 2:
         return "Usage: !send [message]\n", user_id
+    refusal = rate_limited(user_conn, board_bucket)
+    if refusal:
+        return refusal, user_id
 
-    msg = {
-        "user": user_id,
-        "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "text": " ".join(tokens[1:]),
-    }
-    with thread_lock:
-        message_board.append(msg)
-        if len(message_board) > 5:  # Keep the last 5 messages
-            message_board.pop(0)
-
-    global_message(f"[{msg['time']}] {msg['user']} said: {msg['text']}\n", None)
-    return "Message sent successfully.\n", user_id
+    event = {"op": "public", "user": user_id, "time": time.time(), "text": " ".join(tokens[1:])}
+    return publish_and_reply(event, "Message sent successfully.\n", user_id)
 
 def get_message(tokens, user_id, user_conn):
     if not user_id:
@@ -115,111 +472,514 @@ def get_message(tokens, user_id, user_conn):
         return "Usage: !retrieve [id]\n", user_id
 
     try:
-        msg_index = int(tokens[1]) - 1
-        with thread_lock:
-            if 0 <= msg_index < len(message_board):
-                msg = message_board[msg_index]
-                return f"[{msg['time']}] {msg['user']} said: {msg['text']}\n", user_id
-            return "Message ID not found.\n", user_id
+        msg_id = int(tokens[1])
+        with board_lock:
+            msg = message_board.get(msg_id)
+        if msg:
+            return msg, user_id
+        return "Message ID not found.\n", user_id
     except ValueError:
         return "Invalid message ID. Must be a number.\n", user_id
 
 def list_active_users(tokens, user_id, user_conn):
-    with thread_lock:
-        user_list = "\n".join(connected_users.keys())
-    return f"Active users:\n{user_list}\n", user_id
+    return f"Active users:\n{render_roster(None)}\n", user_id
 
 def show_rooms(tokens, user_id, user_conn):
-    room_list = "\n".join(chat_rooms.keys())
-    return f"Available Rooms:\n{room_list}\n", user_id
-    
+    usage = "Usage: !rooms [prefix] [page]\n"
+    if len(tokens) > 3 or (len(tokens) == 3 and not tokens[2].isdigit()):
+        return usage, user_id
+    prefix, page = "", 1
+    if len(tokens) == 3:
+        prefix, page = tokens[1], int(tokens[2])
+    elif len(tokens) == 2:
+        if tokens[1].isdigit():
+            page = int(tokens[1])
+        else:
+            prefix = tokens[1]
+    if page < 1:
+        return usage, user_id
+
+    # Room names are ASCII, so every name with the prefix sorts before prefix + DEL.
+    with rooms_lock:
+        first = bisect.bisect_left(room_index, prefix)
+        last = bisect.bisect_left(room_index, prefix + "\x7f") if prefix else len(room_index)
+        start = first + (page - 1) * ROOMS_PAGE_SIZE
+        names = room_index[start:min(last, start + ROOMS_PAGE_SIZE)]
+    if not names:
+        return "No rooms found.\n", user_id
+    pages = -(-(last - first) // ROOMS_PAGE_SIZE)
+    footer = f"Page {page} of {pages}. Use '!rooms [prefix] [page]' for more.\n" if pages > 1 else ""
+    room_list = "\n".join(names)
+    return f"Available Rooms:\n{room_list}\n{footer}", user_id
+
+def create_room(tokens, user_id, user_conn):
+    if not user_id:
+        return "Register first with '!register [username]'.\n", user_id
+    if len(tokens) != 2:
+        return "Usage: !createroom [room]\n", user_id
+    room_name = tokens[1]
+    if not ROOM_NAME.fullmatch(room_name):
+        return "Room names are 1-32 letters, digits, '-' or '_'.\n", user_id
+    if room_name == "public":
+        # Reserved: commands such as !search and !presence use it for the public board.
+        return "That room name is reserved.\n", user_id
+    if not add_room(room_name):
+        return "Room already exists.\n", user_id
+    if bus:
+        bus.publish({"op": "room_created", "room": room_name})
+    return f"Created {room_name}. Use '!joinroom {room_name}' to enter it.\n", user_id
+
 def join_room(tokens, user_id, user_conn):
+    if not user_id:
+        return "Register first with '!register [username]'.\n", user_id
     if len(tokens) != 2:
         return "Usage: !joinroom [room]\n", user_id
     room_name = tokens[1]
-    with thread_lock:
-        if room_name in chat_rooms:
-            chat_rooms[room_name]["participants"][user_id] = user_conn
-            join_message = f"{user_id} has joined {room_name}.\n"
-            for member_conn in chat_rooms[room_name]["participants"].values():
-                if member_conn != user_conn:  # Avoid sending to the user themselves
-                    try:
-                        member_conn.sendall(join_message.encode())
-                    except:
-                        pass
-            return f"You joined {room_name}.\n", user_id
-        return "Room does not exist.\n", user_id
+    with locked_room(room_name) as room:
+        if room is None:
+            return "Room does not exist.\n", user_id
+        room["participants"] = {**room["participants"], user_id: user_conn}
+    user_conn.rooms.add(room_name)
+    presence_changed(room_name, user_id, True)
+    if user_conn.binary:
+        # Binary clients address the room by id from now on.
+        announce(user_conn, INTERN_ROOM, room_ids, room_name)
+    if bus:
+        bus.publish({"op": "room_join", "room": room_name, "user": user_id})
+    # Avoid sending to the user themselves
+    publish({"op": "room_notice", "room": room_name, "text": f"{user_id} has joined {room_name}.\n", "exclude": user_id})
+    return f"You joined {room_name}.\n", user_id
 
 def send_room_message(tokens, user_id, user_conn):
+    if not user_id:
+        return "Register first with '!register [username]'.\n", user_id
     if len(tokens) < 3:
         return "Usage: !roommsg [room] [message]\n", user_id
     room_name, content = tokens[1], " ".join(tokens[2:])
-    with thread_lock:
-        if room_name in chat_rooms and user_id in chat_rooms[room_name]["participants"]:
-            msg = {
-                "user": user_id,
-                "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "text": content,
-            }
-            chat_rooms[room_name]["logs"].append(msg)
-            for member, conn in chat_rooms[room_name]["participants"].items():
-                if conn != user_conn:
-                    try:
-                        conn.sendall(f"Message in {room_name}: [{msg['time']}] {msg['user']} said: {msg['text']}\n".encode())
-                    except:
-                        pass
-            return f"Message sent to {room_name}.\n", user_id
+    room = chat_rooms.get(room_name)
+    if room is None or user_id not in room["participants"]:
         return "Room does not exist or you are not a participant.\n", user_id
+    refusal = rate_limited(user_conn, room["bucket"])
+    if refusal:
+        return refusal, user_id
+    event = {"op": "room", "room": room_name, "user": user_id, "time": time.time(), "text": content}
+    return publish_and_reply(event, f"Message sent to {room_name}.\n", user_id)
 
 def retrieve_room_message(tokens, user_id, user_conn):
     if len(tokens) != 3:
         return "Usage: !roomretrieve [room] [id]\n", user_id
-    room_name, msg_id = tokens[1], int(tokens[2]) - 1
-    with thread_lock:
-        if room_name in chat_rooms and user_id in chat_rooms[room_name]["participants"]:
-            if 0 <= msg_id < len(chat_rooms[room_name]["logs"]):
-                msg = chat_rooms[room_name]["logs"][msg_id]
-                return f"[{msg['time']}] {msg['user']} said: {msg['text']}\n", user_id
-            return "Message ID not found in the room.\n", user_id
+    room_name, msg_id = tokens[1], int(tokens[2])
+    room = chat_rooms.get(room_name)
+    if room is None or user_id not in room["participants"]:
         return "Room does not exist or you are not a participant.\n", user_id
+    with locked_room(room_name) as room:
+        msg = room["logs"].get(msg_id)
+    if msg:
+        return msg, user_id
+    return "Message ID not found in the room.\n", user_id
+
+def search_messages(tokens, user_id, user_conn):
+    if not user_id:
+        return "Register first with '!register [username]'.\n", user_id
+    if len(tokens) < 3:
+        return "Usage: !search [room|public] [terms]\n", user_id
+    target, query = tokens[1], " ".join(tokens[2:])
+    if target == "public":
+        with board_lock:
+            matches = board_index.search(query)
+        retrieve = "!retrieve [id]"
+    else:
+        room = chat_rooms.get(target)
+        if room is None or user_id not in room["participants"]:
+            return "Room does not exist or you are not a participant.\n", user_id
+        with locked_room(target) as room:
+            matches = room["index"].search(query)
+        retrieve = f"!roomretrieve {target} [id]"
+    if not matches:
+        return "No messages match.\n", user_id
+    return f"Matching message IDs, best first: {' '.join(map(str, matches))}\nUse '{retrieve}' to read one.\n", user_id
+
+def show_history(tokens, user_id, user_conn):
+    usage = "Usage: !history [room|public] [since-id] [limit]\n"
+    if not user_id:
+        return "Register first with '!register [username]'.\n", user_id
+    if not 2 <= len(tokens) <= 4 or not all(token.isdigit() for token in tokens[2:]):
+        return usage, user_id
+    target = tokens[1]
+    since = int(tokens[2]) if len(tokens) > 2 else 0
+    limit = min(int(tokens[3]), MAX_HISTORY_LIMIT) if len(tokens) > 3 else HISTORY_LIMIT
+    if target != "public":
+        room = chat_rooms.get(target)
+        if room is None or user_id not in room["participants"]:
+            return "Room does not exist or you are not a participant.\n", user_id
+    return stream_history(target, since, limit), user_id
+
+def stream_history(target, since, limit):
+    """Yield a header, batches of the messages after since, and a footer telling where to resume.
+
+    Each batch is read under the log's lock and released before the next, so a long catch-up
+    never holds up posting, and nothing beyond one batch is materialized at a time.
+    """
+    yield f"History of {target} after message {since}:\n"
+    sent, last_id = 0, since
+    msg_id = since + 1
+    while sent < limit:
+        if target == "public":
+            with board_lock:
+                msg_id = max(msg_id, message_board.first_id)
+                end = min(message_board.next_id, msg_id + min(HISTORY_BATCH, limit - sent))
+                batch = [message_board.get(i) for i in range(msg_id, end)]
+        else:
+            with locked_room(target) as room:
+                logs = room["logs"]
+                msg_id = max(msg_id, logs.first_id)
+                end = min(logs.next_id, msg_id + min(HISTORY_BATCH, limit - sent))
+                batch = [logs.get(i) for i in range(msg_id, end)]
+        batch = [msg for msg in batch if msg]
+        if not batch:
+            break
+        yield batch
+        sent += len(batch)
+        last_id = batch[-1].msg_id
+        msg_id = end
+    yield f"End of history: {sent} messages. Continue with '!history {target} {last_id}'.\n"
 
 def room_user_list(tokens, user_id, user_conn):
     if len(tokens) != 2:
         return "Usage: !roomusers [room]\n", user_id
     room_name = tokens[1]
-    with thread_lock:
-        if room_name in chat_rooms and user_id in chat_rooms[room_name]["participants"]:
-            participants = "\n".join(chat_rooms[room_name]["participants"].keys())
-            return f"Participants in {room_name}:\n{participants}\n", user_id
-        return "Room does not exist or you are not a participant.\n", user_id
+    room = chat_rooms.get(room_name)
+    if room is not None and user_id in room["participants"]:
+        return f"Participants in {room_name}:\n{render_roster(room_name)}\n", user_id
+    return "Room does not exist or you are not a participant.\n", user_id
+
+def render_roster(scope):
+    """The newline-separated members of the server or a room, re-rendered only after a change."""
+    if scope is None:
+        return rosters.get(None, lambda: "\n".join([*connected_users, *remote_users]))
+    room = chat_rooms.get(scope)
+    participants = room["participants"] if room else {}
+    return rosters.get(scope, lambda: "\n".join([*participants, *remote_members.get(scope, ())]))
+
+def presence_changed(scope, user, joined):
+    """Invalidate a cached roster and push the change to the connections subscribed to it."""
+    if not user:
+        return
+    rosters.invalidate(scope)
+    subscribers = presence.get(scope)
+    if subscribers:
+        fan_out(subscribers, f"Presence {scope or 'public'}: {'+' if joined else '-'}{user}\n", None)
+
+def subscribe_presence(tokens, user_id, user_conn):
+    if len(tokens) not in (2, 3) or tokens[2:] not in ([], ["on"], ["off"]):
+        return "Usage: !presence [public|room] [on|off]\n", user_id
+    target = tokens[1]
+    scope = None if target == "public" else target
+    if tokens[2:] == ["off"]:
+        presence.remove(scope, user_conn)
+        user_conn.subscriptions.discard(scope)
+        return f"Presence updates for {target} stopped.\n", user_id
+    if scope is not None:
+        room = chat_rooms.get(scope)
+        if room is None or user_id not in room["participants"]:
+            return "Room does not exist or you are not a participant.\n", user_id
+    presence.add(scope, user_conn)
+    user_conn.subscriptions.add(scope)
+    # The current roster, then only '+user' and '-user' lines as people come and go.
+    return f"Presence updates for {target} started. Members now:\n{render_roster(scope)}\n", user_id
     
 def exit_room(tokens, user_id, user_conn):
     if len(tokens) != 2:
         return "Usage: !leaveroom [room]\n", user_id
     room_name = tokens[1]
-    with thread_lock:
-        if room_name in chat_rooms and user_id in chat_rooms[room_name]["participants"]:
-            leave_message = f"{user_id} has left {room_name}.\n"
-            for member_conn in chat_rooms[room_name]["participants"].values():
-                if member_conn != user_conn:
-                    try:
-                        member_conn.sendall(leave_message.encode())
-                    except:
-                        pass
-            # Remove the user from the room
-            chat_rooms[room_name]["participants"].pop(user_id)
-            return f"You left {room_name}.\n", user_id
+    if room_name not in chat_rooms:
         return "Room does not exist or you are not a participant.\n", user_id
+    with locked_room(room_name) as room:
+        if room is None or user_id not in room["participants"]:
+            return "Room does not exist or you are not a participant.\n", user_id
+        # Remove the user from the room
+        room["participants"] = {user: conn for user, conn in room["participants"].items() if user != user_id}
+    user_conn.rooms.discard(room_name)
+    if room_name in user_conn.subscriptions:
+        presence.remove(room_name, user_conn)
+        user_conn.subscriptions.discard(room_name)
+    presence_changed(room_name, user_id, False)
+    if bus:
+        bus.publish({"op": "room_leave", "room": room_name, "user": user_id})
+    publish({"op": "room_notice", "room": room_name, "text": f"{user_id} has left {room_name}.\n", "exclude": user_id})
+    return f"You left {room_name}.\n", user_id
+
+def format_message(msg):
+    """Render a stored message the way it is shown to clients."""
+    timestamp = datetime.fromtimestamp(msg.time).strftime("%Y-%m-%d %H:%M:%S")
+    return f"[{timestamp}] {msg.user} said: {msg.text}\n"
+
+# Room index and lifecycle
+def room_exists(room_name):
+    position = bisect.bisect_left(room_index, room_name)
+    return position < len(room_index) and room_index[position] == room_name
+
+def add_room(room_name):
+    """Add a room to the index, returning False if it already exists. Its state is allocated on first use."""
+    with rooms_lock:
+        if room_exists(room_name):
+            return False
+        bisect.insort(room_index, room_name)
+    if rooms_dir:
+        # Lets the room survive a restart even if nobody writes to it first.
+        os.makedirs(os.path.join(rooms_dir, room_name), exist_ok=True)
+    return True
+
+def load_room(room_name):
+    """Return the in-memory state of a room, allocating it if needed, or None if there is no such room."""
+    room = chat_rooms.get(room_name)
+    if room is not None or not room_exists(room_name):
+        return room
+    with rooms_lock:
+        room = chat_rooms.get(room_name)
+        if room is None:
+            if rooms_dir:
+                logs = MessageLog(os.path.join(rooms_dir, room_name), max_segments=room_segments)
+            else:
+                logs = RingLog(ROOM_CAPACITY, evicted_next_ids.pop(room_name, 1))
+            # Read before the room is visible, so backfill and new messages never overlap.
+            backfill_from = logs.next_id if len(logs) else None
+            room = {"participants": {}, "logs": logs, "lock": metrics.make_lock("room"),
+                    "index": SearchIndex(MAX_INDEXED if rooms_dir else None),
+                    "bucket": make_bucket(ROOM_RATE, ROOM_BURST),
+                    "last_active": time.monotonic(), "evicted": False}
+            chat_rooms[room_name] = room
+            if backfill_from:
+                start_backfill(room, backfill_from)
+            if metrics.enabled:
+                metrics.rooms_loaded.inc()
+        return room
+
+@contextmanager
+def locked_room(room_name):
+    """Hold the lock of a loaded room, or yield None if the room does not exist.
+
+    A room the sweeper evicted between loading and locking is loaded again, so callers never
+    touch the logs of an evicted room.
+    """
+    while True:
+        room = load_room(room_name)
+        if room is None:
+            yield None
+            return
+        with room["lock"]:
+            if not room["evicted"]:
+                room["last_active"] = time.monotonic()
+                yield room
+                return
+
+def start_backfill(room, before):
+    """Index the messages below id before that a durable log held when its index was created."""
+    threading.Thread(target=backfill_index, args=(room, before), daemon=True).start()
+
+def backfill_index(room, before):
+    """Fill a new index from its log one batch per lock hold; room is None for the public board.
+
+    Runs on its own thread, so opening a large log never stalls posting or the event loop.
+    Until it finishes, searches cover the newest messages and those already backfilled.
+    """
+    while before is not None:
+        if room is None:
+            with board_lock:
+                before = board_index.backfill(message_board, before)
+        else:
+            with room["lock"]:
+                if room["evicted"]:
+                    return
+                before = room["index"].backfill(room["logs"], before)
 
-def global_message(msg, current_user):
-    """Send a global message to all users in the board."""
-    with thread_lock:
-        for user, connection in connected_users.items():
-            if user != current_user:
-                try:
-                    connection.sendall(msg.encode())
-                except:
-                    pass
+def evict_idle_rooms(idle_seconds):
+    """Unload rooms that have had no local participants for idle_seconds."""
+    cutoff = time.monotonic() - idle_seconds
+    for room_name, room in list(chat_rooms.items()):
+        if room["participants"] or room["last_active"] > cutoff:
+            continue
+        with room["lock"]:
+            if room["participants"] or room["last_active"] > cutoff:
+                continue
+            room["evicted"] = True
+            logs = room["logs"]
+            if isinstance(logs, MessageLog):
+                logs.close()
+        with rooms_lock:
+            if isinstance(logs, RingLog):
+                evicted_next_ids[room_name] = logs.next_id
+            del chat_rooms[room_name]
+        rosters.forget(room_name)
+        if metrics.enabled:
+            metrics.rooms_loaded.dec()
+
+def run_room_sweeper(idle_seconds):
+    while True:
+        time.sleep(max(1.0, idle_seconds / 4))
+        evict_idle_rooms(idle_seconds)
+
+def enable_metrics():
+    """Turn on instrumentation and swap the state locks for timed ones."""
+    global registry_lock, board_lock, rooms_lock
+    metrics.enable()
+    registry_lock = metrics.make_lock("registry")
+    board_lock = metrics.make_lock("board")
+    rooms_lock = metrics.make_lock("rooms")
+
+def configure_capacity(board_capacity, room_capacity):
+    """Resize the in-memory public board and room buffers."""
+    global message_board, board_index, ROOM_CAPACITY
+    message_board = RingLog(board_capacity)
+    board_index = SearchIndex()
+    ROOM_CAPACITY = room_capacity
+
+def configure_storage(data_dir, max_segments=MAX_SEGMENTS):
+    """Back the public board and every room with durable logs under data_dir."""
+    global message_board, board_index, rooms_dir, room_segments
+    message_board = MessageLog(os.path.join(data_dir, "public"), max_segments=max_segments)
+    board_index = SearchIndex(MAX_INDEXED)
+    if len(message_board):
+        start_backfill(None, message_board.next_id)
+    rooms_dir = os.path.join(data_dir, "rooms")
+    room_segments = max_segments
+    os.makedirs(rooms_dir, exist_ok=True)
+    for room_name in os.listdir(rooms_dir):
+        if ROOM_NAME.fullmatch(room_name):
+            add_room(room_name)
+
+def publish(event):
+    """Apply a broadcast event here, or hand it to the bus so every worker applies it in the same order."""
+    if bus:
+        bus.publish(event)
+    else:
+        apply_event(event)
+
+def publish_and_reply(event, reply, user_id):
+    """Publish a message a client posted and return its reply once this worker has stored it.
+
+    With --workers the message is stored only when the bus relays it back, so replying
+    earlier would let a pipelined !retrieve or !search miss the client's own post.
+    """
+    if not bus:
+        apply_event(event)
+        return reply, user_id
+    if serving_async:
+        # The event loop must keep serving other clients during the round trip.
+        return publish_async_and_reply(event, reply, user_id), user_id
+    bus.publish_and_wait(event)
+    return reply, user_id
+
+async def publish_async_and_reply(event, reply, user_id):
+    await bus.publish_async(event)
+    return reply, user_id
+
+def apply_event(event):
+    """Deliver a broadcast event to local connections, or update the mirrors of other workers' users."""
+    op = event["op"]
+    if op == "global":
+        global_message(event["text"], event["exclude"])
+    elif op == "public":
+        msg = Message(event["user"], event["time"], event["text"])
+        with board_lock:
+            message_board.append(msg)
+            board_index.update(message_board, msg)
+        global_message(format_message(msg), None, msg)
+    elif op == "room":
+        msg = Message(event["user"], event["time"], event["text"])
+        with locked_room(event["room"]) as room:
+            if room is None:
+                return
+            room["logs"].append(msg)
+            room["index"].update(room["logs"], msg)
+        room_message(event["room"], f"Message in {event['room']}: {format_message(msg)}", msg.user, msg)
+    elif op == "room_notice":
+        room_message(event["room"], event["text"], event["exclude"])
+    elif op == "room_created":
+        add_room(event["room"])
+    elif event["origin"] != bus.worker_id:
+        apply_remote_membership(event)
+
+def apply_remote_membership(event):
+    """Track users and room members that live on other worker processes."""
+    global remote_users
+    op, user = event["op"], event["user"]
+    changes = []
+    with registry_lock:
+        if op == "user_joined":
+            remote_users = remote_users | {user}
+            changes.append((None, True))
+        elif op == "user_left":
+            remote_users = remote_users - {user}
+            changes.append((None, False))
+            for room_name, members in remote_members.items():
+                if user in members:
+                    remote_members[room_name] = members - {user}
+                    changes.append((room_name, False))
+        elif op == "room_join":
+            remote_members[event["room"]] = remote_members.get(event["room"], frozenset()) | {user}
+            changes.append((event["room"], True))
+        elif op == "room_leave":
+            remote_members[event["room"]] = remote_members.get(event["room"], frozenset()) - {user}
+            changes.append((event["room"], False))
+    for scope, joined in changes:
+        presence_changed(scope, user, joined)
+
+def room_message(room_name, msg, current_user, stored=None):
+    """Queue a message for every local participant of a room except current_user."""
+    room = chat_rooms.get(room_name)
+    if room is None:
+        return
+    participants = room["participants"]
+    fan_out(participants, msg, current_user, stored, room_name)
+    if metrics.enabled:
+        metrics.fanout_recipients.labels("room").observe(len(participants))
+
+def global_message(msg, current_user, stored=None):
+    """Queue a global message for every user on the board; slow readers never stall the caller."""
+    users = connected_users
+    fan_out(users, msg, current_user, stored)
+    if metrics.enabled:
+        metrics.fanout_recipients.labels("global").observe(len(users))
+
+def fan_out(recipients, msg, current_user, stored=None, room_name=None):
+    """Send rendered text to text clients and, when a stored message is given, a message frame to binary ones."""
+    # Encoded at most once per protocol; every recipient's queue shares the same bytes object.
+    data = msg.encode()
+    frame = None
+    for user, connection in recipients.items():
+        if user == current_user:
+            continue
+        if not connection.binary:
+            connection.send(data)
+            continue
+        if frame is None:
+            if stored is None:
+                frame = encode_frame(OP_SERVER_TEXT, 0, data)
+            else:
+                frame = encode_message(room_ids.id_for(room_name) if room_name else 0, stored, user_ids.id_for(stored.user))
+        if stored is not None:
+            if not announce(connection, INTERN_USER, user_ids, stored.user):
+                continue
+            if room_name and not announce(connection, INTERN_ROOM, room_ids, room_name):
+                continue
+        connection.send(frame)
+
+def announce(connection, kind, interner, name):
+    """Make sure a binary connection knows the id of a user or room name before it is used."""
+    ident = interner.id_for(name)
+    if (kind, ident) in connection.interned:
+        return True
+    # Marked only once queued, so a concurrent sender never relies on an announcement still in flight.
+    if not connection.send(encode_intern(kind, ident, name)):
+        return False
+    connection.interned.add((kind, ident))
+    return True
+
+def show_stats(tokens, user_id, user_conn):
+    if not metrics.enabled:
+        return "Metrics are disabled. Start the server with --metrics to collect them.\n", user_id
+    return f"Server statistics:\n{metrics.summary()}", user_id
 
 def help_menu(tokens, user_id, user_conn):
     help_text = """
@@ -229,21 +989,184 @@ def help_menu(tokens, user_id, user_conn):
         - !send [message]: Post a public message.
         - !retrieve [id]: View a specific public message by ID.
         - !active: See a list of active users.
-        - !rooms: View available chat rooms.
+        - !rooms [prefix] [page]: List chat rooms, optionally only those starting with prefix.
+        - !createroom [room]: Create a new chat room.
         - !joinroom [room]: Join a private chat room.
         - !roommsg [room] [message]: Send a message to a chat room.
         - !roomretrieve [room] [id]: Retrieve a specific message from a chat room.
+        - !history [room|public] [since-id] [limit]: Stream the messages after since-id in one reply.
+        - !search [room|public] [terms]: Find messages containing the terms, best matches first.
         - !roomusers [room]: List participants in a chat room.
+        - !presence [public|room] [on|off]: Get the member list once, then only join/leave updates.
         - !leaveroom [room]: Leave a chat room.
+        - !stats: Show server statistics (when metrics are enabled).
+        - !compress: Compress everything the server sends on this connection (for client programs).
+        - !binary: Switch this connection to the compact binary protocol (for client programs).
         - !quit: Disconnect from the server.
     """
     return help_text, user_id
 
-if __name__ == "__main__":
+def run_threaded_server(host, port, reuse_port=False):
+    """Accept connections and serve each client on its own thread."""
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
-        server_socket.bind((SERVER_ADDRESS, SERVER_PORT))
+        if reuse_port:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server_socket.bind((host, port))
         server_socket.listen()
-        print(f"Server running on {SERVER_ADDRESS}:{SERVER_PORT}")
+        print(f"Server running on {host}:{port}")
         while True:
             conn, addr = server_socket.accept()
-            threading.Thread(target=client_handler, args=(conn, addr), daemon=True).start()
\ No newline at end of file
+            threading.Thread(target=client_handler, args=(conn, addr), daemon=True).start()
+
+async def run_async_server(host, port, reuse_port=False):
+    """Serve every client from a single asyncio event loop."""
+    global serving_async
+    serving_async = True
+    server = await asyncio.start_server(async_client_handler, host, port, backlog=4096, reuse_port=reuse_port or None)
+    print(f"Server running on {host}:{port} (asyncio)")
+    async with server:
+        await server.serve_forever()
+
+def configure(args, worker_id=None):
+    """Apply the storage, queue, limit and metrics settings from the command line."""
+    global OUTBOUND_QUEUE_SIZE, COMPRESS_THRESHOLD, HIGH_WATER, board_bucket
+    global MAX_CONNECTIONS, MAX_USERS, USER_RATE, USER_BURST, ROOM_RATE, ROOM_BURST
+    OUTBOUND_QUEUE_SIZE = args.max_pending
+    COMPRESS_THRESHOLD = args.compress_threshold
+    # Leave room in the queue for the disconnect notice and the close marker.
+    HIGH_WATER = max(1, min(args.high_water, args.max_pending - 2)) if args.high_water > 0 else 0
+    MAX_CONNECTIONS, MAX_USERS = args.max_connections, args.max_users
+    USER_RATE, USER_BURST = args.user_rate, args.user_burst
+    ROOM_RATE, ROOM_BURST = args.room_rate, args.room_burst
+    board_bucket = make_bucket(ROOM_RATE, ROOM_BURST)
+    if args.capture:
+        start_capture(args.capture if worker_id is None else f"{args.capture}.worker-{worker_id}")
+    if args.metrics or args.metrics_port:
+        enable_metrics()
+        if args.metrics_port:
+            # Workers each expose their own endpoint on consecutive ports.
+            metrics.serve_http("127.0.0.1", args.metrics_port + (worker_id or 0))
+    if args.room_idle > 0:
+        threading.Thread(target=run_room_sweeper, args=(args.room_idle,), daemon=True).start()
+    if args.data_dir:
+        # Every worker keeps its own replica of the logs, written in bus order.
+        data_dir = args.data_dir if worker_id is None else os.path.join(args.data_dir, f"worker-{worker_id}")
+        configure_storage(data_dir, args.max_segments)
+    else:
+        configure_capacity(args.board_capacity, args.room_capacity)
+
+def start_capture(path):
+    """Record inbound traffic to path until the process exits."""
+    global capture
+    capture = CaptureWriter(path)
+    atexit.register(capture.close)
+    # Exit normally on SIGTERM so the buffered tail of the capture is written out.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+def serve(args):
+    if args.mode == "async":
+        try:
+            asyncio.run(run_async_server(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+    else:
+        run_threaded_server(args.host, args.port)
+
+def run_worker(args, worker_id, bus_path):
+    """Entry point of one worker process sharing the listening port with its siblings."""
+    global bus
+    configure(args, worker_id)
+    try:
+        if args.mode == "async":
+            async def serve_with_bus():
+                global bus
+                loop = asyncio.get_running_loop()
+                # Bus events arrive on the bus thread; apply them on the event loop.
+                bus = BusClient(bus_path, worker_id, lambda event: loop.call_soon_threadsafe(apply_event, event))
+                await run_async_server(args.host, args.port, reuse_port=True)
+            asyncio.run(serve_with_bus())
+        else:
+            bus = BusClient(bus_path, worker_id, apply_event)
+            run_threaded_server(args.host, args.port, reuse_port=True)
+    except KeyboardInterrupt:
+        pass
+
+def run_workers(args):
+    """Fork args.workers server processes on one SO_REUSEPORT port, joined by a local message bus."""
+    if not hasattr(socket, "SO_REUSEPORT") or not hasattr(socket, "AF_UNIX"):
+        raise SystemExit("--workers needs SO_REUSEPORT and Unix-domain sockets, which this platform lacks.")
+    bus_path = args.bus_path or os.path.join(tempfile.mkdtemp(prefix="bulletin-bus-"), "bus.sock")
+    broker = Broker(bus_path)
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=run_worker, args=(args, worker_id, bus_path), daemon=True)
+               for worker_id in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    threading.Thread(target=broker.serve_forever, daemon=True).start()
+    print(f"Started {args.workers} workers sharing {args.host}:{args.port} (bus at {bus_path})")
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        pass
+
+def positive_int(value):
+    """argparse type for sizes that must be at least 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Interactive Bulletin Board server")
+    parser.add_argument("--host", default=SERVER_ADDRESS, help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=SERVER_PORT, help="Port to listen on.")
+    parser.add_argument("--max-pending", type=positive_int, default=OUTBOUND_QUEUE_SIZE,
+                        help="Outbound messages queued per client before further broadcasts to it are dropped.")
+    parser.add_argument("--high-water", type=int, default=HIGH_WATER,
+                        help="Disconnect a client once this many broadcasts are waiting for it (below --max-pending); 0 never does.")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS,
+                        help="Open connections accepted per process before new ones are turned away; 0 is unlimited.")
+    parser.add_argument("--max-users", type=int, default=MAX_USERS,
+                        help="Registered users allowed at once across the server; 0 is unlimited.")
+    parser.add_argument("--user-rate", type=float, default=USER_RATE,
+                        help="Messages per second each client may post with !send and !roommsg; 0 is unlimited.")
+    parser.add_argument("--user-burst", type=int, default=USER_BURST,
+                        help="Messages a client may post at once before --user-rate applies.")
+    parser.add_argument("--room-rate", type=float, default=ROOM_RATE,
+                        help="Messages per second all clients together may post to one room or the public board; 0 is unlimited.")
+    parser.add_argument("--room-burst", type=int, default=ROOM_BURST,
+                        help="Messages a room may receive at once before --room-rate applies.")
+    parser.add_argument("--compress-threshold", type=int, default=COMPRESS_THRESHOLD,
+                        help="Bytes a write must reach before it is compressed for clients that sent !compress.")
+    parser.add_argument("--board-capacity", type=positive_int, default=BOARD_CAPACITY,
+                        help="Newest public messages kept in memory when --data-dir is not set.")
+    parser.add_argument("--room-capacity", type=positive_int, default=ROOM_CAPACITY,
+                        help="Newest messages kept in memory per room when --data-dir is not set.")
+    parser.add_argument("--room-idle", type=float, default=ROOM_IDLE_SECONDS,
+                        help="Seconds an empty room stays in memory before it is evicted; 0 never evicts.")
+    parser.add_argument("--data-dir",
+                        help="Persist the public board and room logs under this directory so they survive restarts.")
+    parser.add_argument("--max-segments", type=positive_int, default=MAX_SEGMENTS,
+                        help="Log segments kept per board or room when --data-dir is set; older ones are deleted.")
+    parser.add_argument("--capture", metavar="PATH",
+                        help="Record every connection's commands with timestamps to PATH (gzipped if it ends in .gz) for replay.py.")
+    parser.add_argument("--mode", choices=("thread", "async"), default="thread",
+                        help="'thread' spawns one thread per client; 'async' serves all clients from one event loop.")
+    parser.add_argument("--metrics", action="store_true",
+                        help="Collect command latency, lock, fan-out and traffic metrics, shown by !stats.")
+    parser.add_argument("--metrics-port", type=int,
+                        help="Also serve the metrics as text at http://127.0.0.1:PORT/metrics (implies --metrics).")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes sharing the port through SO_REUSEPORT (Linux/BSD only).")
+    parser.add_argument("--bus-path",
+                        help="Unix-domain socket path for the worker message bus; defaults to a temporary directory.")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.workers > 1:
+        run_workers(args)
+    else:
+        configure(args)
+        serve(args)
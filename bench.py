@@ -0,0 +1,305 @@
+"""Load generator and latency benchmark for the bulletin board server.
+
+Launches backend.py on a free local port (or targets a running server with --connect),
+opens many simulated clients that speak the normal text protocol, and reports the
+connection rate, commands per second, broadcast fan-out delay and per-command latency
+percentiles. Commands are sent with reply tags so latency is measured per command even
+while broadcasts are interleaved with replies.
+
+    python bench.py --scenario hot-room --clients 1000 --duration 10
+    python bench.py --scenario slow-readers --json results.json -- --mode async
+
+The generator itself is a single process; when it saturates a core, run several
+instances with --connect against one server and merge their JSON results.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+from protocol import RECV_SIZE, ReplyReader, encode_command
+
+ROOMS = [f"Room{i + 1}" for i in range(5)]
+
+# Room messages carry their send time so receivers can measure fan-out delay
+FANOUT_MARKER = "said: bench "
+
+
+def hot_room(client, rng):
+    """Everyone talks in one room."""
+    roll = rng.random()
+    if roll < 0.9:
+        return f"!roommsg {client.room} bench {time.monotonic_ns()}"
+    if roll < 0.95:
+        return f"!roomretrieve {client.room} 1"
+    return f"!roomusers {client.room}"
+
+
+def quiet_rooms(client, rng):
+    """Clients spread over every room and mostly read history."""
+    roll = rng.random()
+    if roll < 0.3:
+        return f"!roommsg {client.room} bench {time.monotonic_ns()}"
+    if roll < 0.8:
+        return f"!roomretrieve {client.room} 1"
+    if roll < 0.9:
+        return "!active"
+    return "!rooms"
+
+
+SCENARIOS = {
+    # name: (command picker, rooms used, fraction of slow readers, per-client commands per second)
+    # A number instead of a room list creates one new room per that many clients.
+    "hot-room": (hot_room, ROOMS[:1], 0.0, 2.0),
+    "quiet-rooms": (quiet_rooms, ROOMS, 0.0, 0.5),
+    "many-rooms": (quiet_rooms, 4, 0.0, 0.5),
+    "slow-readers": (hot_room, ROOMS[:1], 0.2, 2.0),
+}
+
+
+class SimClient:
+    """One simulated user holding a connection and matching tagged replies to requests."""
+
+    def __init__(self, name, room, stats, slow=False):
+        self.name = name
+        self.room = room
+        self.stats = stats
+        self.slow = slow
+        self.pending = {}
+        self.next_tag = 0
+        self.partial = ""
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.listener = asyncio.get_running_loop().create_task(self.listen())
+
+    async def request(self, command):
+        """Send a tagged command and record how long its reply took."""
+        self.next_tag += 1
+        tag = self.next_tag
+        reply = asyncio.get_running_loop().create_future()
+        self.pending[tag] = reply
+        started = time.perf_counter()
+        self.writer.write(encode_command(command, tag))
+        await reply
+        self.stats.record(command.split()[0], time.perf_counter() - started)
+
+    async def listen(self):
+        replies = ReplyReader()
+        try:
+            while True:
+                data = await self.reader.read(1024 if self.slow else RECV_SIZE)
+                if not data:
+                    break
+                for tag, text in replies.feed(data):
+                    if tag is None:
+                        self.on_broadcast(text)
+                    elif tag in self.pending:
+                        self.pending.pop(tag).set_result(text)
+                if self.slow:
+                    await asyncio.sleep(0.05)
+        except (ConnectionError, OSError):
+            pass
+        for reply in self.pending.values():
+            reply.cancel()
+
+    def on_broadcast(self, text):
+        lines = (self.partial + text).split("\n")
+        self.partial = lines.pop()
+        now = time.monotonic_ns()
+        for line in lines:
+            marker = line.rfind(FANOUT_MARKER)
+            sent = line[marker + len(FANOUT_MARKER):]
+            if marker >= 0 and sent.isdigit():
+                self.stats.fanout.append((now - int(sent)) / 1e9)
+
+    async def close(self):
+        self.listener.cancel()
+        self.writer.close()
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = {}
+        self.fanout = []
+        self.errors = 0
+
+    def record(self, command, seconds):
+        self.latencies.setdefault(command, []).append(seconds)
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def summarize(samples):
+    if not samples:
+        return {"count": 0}
+    return {
+        "count": len(samples),
+        "mean_ms": sum(samples) / len(samples) * 1000,
+        "p50_ms": percentile(samples, 0.50) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "p999_ms": percentile(samples, 0.999) * 1000,
+        "max_ms": max(samples) * 1000,
+    }
+
+
+async def drive(client, picker, rate, until, rng):
+    """Issue commands at roughly `rate` per second, with jitter, until the deadline."""
+    while True:
+        delay = rng.expovariate(rate)
+        if time.monotonic() + delay >= until:
+            return
+        await asyncio.sleep(delay)
+        try:
+            await client.request(picker(client, rng))
+        except (asyncio.CancelledError, ConnectionError, OSError):
+            client.stats.errors += 1
+            return
+
+
+async def run_scenario(host, port, scenario, clients, duration, seed):
+    picker, rooms, slow_fraction, rate = SCENARIOS[scenario]
+    rng = random.Random(seed)
+    stats = Stats()
+    created = []
+    if isinstance(rooms, int):
+        rooms = created = [f"bench-{i}" for i in range(max(1, clients // rooms))]
+    sims = [SimClient(f"bench{i}", rooms[i % len(rooms)], stats, slow=rng.random() < slow_fraction)
+            for i in range(clients)]
+
+    # Connect and register everyone before measuring steady-state traffic.
+    started = time.perf_counter()
+    for start in range(0, clients, 200):
+        await asyncio.gather(*(sim.connect(host, port) for sim in sims[start:start + 200]))
+    connect_seconds = time.perf_counter() - started
+    await asyncio.gather(*(sim.request(f"!register {sim.name}") for sim in sims))
+    # The first len(rooms) clients hold one room each, so each creates its own.
+    await asyncio.gather(*(sim.request(f"!createroom {room}") for sim, room in zip(sims, created)))
+    await asyncio.gather(*(sim.request(f"!joinroom {sim.room}") for sim in sims))
+    setup_seconds = time.perf_counter() - started
+
+    stats.latencies.clear()
+    stats.fanout.clear()
+    measured_from = time.perf_counter()
+    until = time.monotonic() + duration
+    await asyncio.gather(*(drive(sim, picker, rate, until, random.Random(rng.random())) for sim in sims))
+    elapsed = time.perf_counter() - measured_from
+
+    await asyncio.gather(*(sim.close() for sim in sims))
+    commands = sum(len(samples) for samples in stats.latencies.values())
+    return {
+        "scenario": scenario,
+        "clients": clients,
+        "slow_clients": sum(sim.slow for sim in sims),
+        "duration_s": elapsed,
+        "connect_per_s": clients / connect_seconds if connect_seconds else None,
+        "setup_s": setup_seconds,
+        "commands": commands,
+        "commands_per_s": commands / elapsed if elapsed else None,
+        "errors": stats.errors,
+        "latency": {command: summarize(samples) for command, samples in sorted(stats.latencies.items())},
+        "all_commands": summarize([s for samples in stats.latencies.values() for s in samples]),
+        "fanout_delay": summarize(stats.fanout),
+    }
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def launch_server(port, server_args):
+    backend = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend.py")
+    server = subprocess.Popen([sys.executable, backend, "--port", str(port), *server_args],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    server.kill()
+    raise SystemExit("backend.py did not start listening within 10 seconds.")
+
+
+def raise_fd_limit():
+    """Thousands of clients need thousands of descriptors; lift the soft limit where possible."""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def print_report(result):
+    print(f"Scenario {result['scenario']}: {result['clients']} clients "
+          f"({result['slow_clients']} slow) for {result['duration_s']:.1f}s")
+    print(f"  connections/s  {result['connect_per_s']:.0f}")
+    print(f"  commands/s     {result['commands_per_s']:.0f} ({result['commands']} total, {result['errors']} errors)")
+    rows = [("all", result["all_commands"]), ("fan-out", result["fanout_delay"])]
+    rows += sorted(result["latency"].items())
+    print(f"  {'':14} {'count':>8} {'p50 ms':>9} {'p99 ms':>9} {'p999 ms':>9}")
+    for name, summary in rows:
+        if summary["count"]:
+            print(f"  {name:14} {summary['count']:>8} {summary['p50_ms']:>9.2f} "
+                  f"{summary['p99_ms']:>9.2f} {summary['p999_ms']:>9.2f}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the bulletin board server.",
+                                     epilog="Arguments after '--' are passed to backend.py.")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="hot-room")
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of measured traffic.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--connect", metavar="HOST:PORT", help="Benchmark a running server instead of launching one.")
+    parser.add_argument("--json", metavar="PATH", help="Write machine-readable results here ('-' for stdout).")
+    parser.add_argument("server_args", nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+    if args.server_args[:1] == ["--"]:
+        args.server_args = args.server_args[1:]
+    return args
+
+
+def main():
+    args = parse_args()
+    raise_fd_limit()
+    server = None
+    if args.connect:
+        host, _, port = args.connect.rpartition(":")
+        port = int(port)
+    else:
+        host, port = "127.0.0.1", free_port()
+        server = launch_server(port, args.server_args)
+    try:
+        result = asyncio.run(run_scenario(host, port, args.scenario, args.clients, args.duration, args.seed))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+    result["server_args"] = args.server_args
+    if args.json == "-":
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(result)
+        if args.json:
+            with open(args.json, "w") as output:
+                json.dump(result, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
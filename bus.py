@@ -0,0 +1,224 @@
+import asyncio
+import itertools
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+
+# How long a worker waits for the broker to answer a username claim
+CLAIM_TIMEOUT = 5.0
+# How long a worker waits for one of its own events to come back from the broker
+RELAY_TIMEOUT = 5.0
+
+
+def encode_event(event):
+    return json.dumps(event, separators=(",", ":")).encode() + b"\n"
+
+
+def read_events(sock):
+    """Yield events read from a bus socket until it closes."""
+    with sock.makefile("rb") as stream:
+        for line in stream:
+            yield json.loads(line)
+
+
+class Broker:
+    """Relays events between worker processes over a Unix-domain socket.
+
+    Every event is forwarded to all workers, including the one that sent it, while the
+    broker lock is held, so all workers observe broadcasts in the same order. The broker is
+    also the authority on which usernames are taken across the whole server.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.workers = {}  # worker socket -> usernames registered through it
+        self.users = {}  # username -> worker socket
+        if os.path.exists(path):
+            os.unlink(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen()
+
+    def serve_forever(self):
+        while True:
+            conn, _ = self.server.accept()
+            with self.lock:
+                self.workers[conn] = set()
+            threading.Thread(target=self._serve_worker, args=(conn,), daemon=True).start()
+
+    def _serve_worker(self, conn):
+        try:
+            for event in read_events(conn):
+                self._handle(conn, event)
+        except (OSError, ValueError):
+            pass
+        finally:
+            # A worker that goes away takes its users with it.
+            with self.lock:
+                for user in self.workers.pop(conn, ()):
+                    self.users.pop(user, None)
+                    self._broadcast({"op": "user_left", "user": user, "origin": None})
+            conn.close()
+
+    def _handle(self, conn, event):
+        with self.lock:
+            op = event["op"]
+            if op == "claim":
+                user = event["user"]
+                accepted = user not in self.users
+                if accepted:
+                    self.users[user] = conn
+                    self.workers[conn].add(user)
+                self._send(conn, {"op": "claim_result", "req": event["req"], "ok": accepted})
+                if accepted:
+                    self._broadcast({"op": "user_joined", "user": user, "origin": event["origin"]})
+            elif op == "release":
+                user = event["user"]
+                if self.users.get(user) is conn:
+                    del self.users[user]
+                    self.workers[conn].discard(user)
+                    self._broadcast({"op": "user_left", "user": user, "origin": event["origin"]})
+            else:
+                self._broadcast(event)
+
+    def _send(self, conn, event):
+        try:
+            conn.sendall(encode_event(event))
+        except OSError:
+            pass
+
+    def _broadcast(self, event):
+        data = encode_event(event)
+        for conn in list(self.workers):
+            try:
+                conn.sendall(data)
+            except OSError:
+                pass
+
+
+class BusClient:
+    """A worker's connection to the broker; received events are handed to dispatch."""
+
+    def __init__(self, path, worker_id, dispatch, connect_timeout=10.0):
+        self.worker_id = worker_id
+        self.dispatch = dispatch
+        self.send_lock = threading.Lock()
+        self.pending = {}
+        self.requests = itertools.count(1)
+
+        deadline = time.monotonic() + connect_timeout
+        while True:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                self.sock.connect(path)
+                break
+            except OSError:
+                self.sock.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        threading.Thread(target=self._listen, daemon=True).start()
+
+    def publish(self, event):
+        """Send an event to every worker, this one included."""
+        event["origin"] = self.worker_id
+        data = encode_event(event)
+        with self.send_lock:
+            self.sock.sendall(data)
+
+    def claim(self, user):
+        """Ask the broker to reserve a username server-wide. Blocks until it answers."""
+        req = next(self.requests)
+        done = threading.Event()
+        self.pending[req] = [done, False]
+        self.publish({"op": "claim", "user": user, "req": req})
+        if not done.wait(CLAIM_TIMEOUT):
+            # A late acceptance must not leave the name reserved for nobody.
+            self.release(user)
+        return self.pending.pop(req)[1]
+
+    async def claim_async(self, user):
+        """Event-loop version of claim(): waits for the broker without blocking other clients."""
+        loop = asyncio.get_running_loop()
+        req = next(self.requests)
+        answer = loop.create_future()
+        self.pending[req] = answer
+        self.publish({"op": "claim", "user": user, "req": req})
+        try:
+            return await asyncio.wait_for(answer, CLAIM_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.release(user)
+            return False
+        finally:
+            self.pending.pop(req, None)
+
+    def publish_and_wait(self, event):
+        """Publish an event, then block until this worker has applied it too.
+
+        A handler that replies after this knows the client's next command will see the event.
+        """
+        req = next(self.requests)
+        done = threading.Event()
+        self.pending[req] = [done, False]
+        event["req"] = req
+        self.publish(event)
+        done.wait(RELAY_TIMEOUT)
+        self.pending.pop(req, None)
+
+    async def publish_async(self, event):
+        """Event-loop version of publish_and_wait()."""
+        loop = asyncio.get_running_loop()
+        req = next(self.requests)
+        applied = loop.create_future()
+        self.pending[req] = applied
+        event["req"] = req
+        self.publish(event)
+        try:
+            await asyncio.wait_for(applied, RELAY_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.pending.pop(req, None)
+
+    def release(self, user):
+        self.publish({"op": "release", "user": user})
+
+    def _answer(self, req, value):
+        """Wake whoever waits on a request, on its own thread or event loop."""
+        slot = self.pending.get(req)
+        if isinstance(slot, asyncio.Future):
+            slot.get_loop().call_soon_threadsafe(_resolve, slot, value)
+        elif slot:
+            slot[1] = value
+            slot[0].set()
+
+    def _listen(self):
+        try:
+            for event in read_events(self.sock):
+                if event["op"] == "claim_result":
+                    self._answer(event["req"], event["ok"])
+                    continue
+                try:
+                    self.dispatch(event)
+                except Exception:
+                    # One bad event must not stop this worker from applying the ones after it.
+                    print(f"Worker {self.worker_id} failed to apply a {event.get('op')} event:")
+                    traceback.print_exc()
+                if event.get("origin") == self.worker_id and "req" in event:
+                    # Queued behind the dispatch, so on an event loop it runs after the event is applied.
+                    self._answer(event["req"], True)
+        except (OSError, ValueError) as e:
+            print(f"Worker {self.worker_id} lost the message bus: {e}")
+        finally:
+            # Shared state can no longer be kept consistent, so stop serving.
+            os._exit(1)
+
+
+def _resolve(answer, ok):
+    # The claim may have timed out and been cancelled before the answer arrived.
+    if not answer.done():
+        answer.set_result(ok)
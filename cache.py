@@ -0,0 +1,77 @@
+import threading
+from collections import OrderedDict
+
+# Messages a client remembers before the least recently used are forgotten
+MESSAGE_CACHE_SIZE = 1000
+
+# Shown before a retrieval answered without asking the server
+CACHE_HIT = "(cached) "
+
+
+def retrieval_key(tokens):
+    """Return the (room or None for the public board, id) a retrieval command asks for, or None."""
+    if len(tokens) == 2 and tokens[0] == "!retrieve" and tokens[1].isdigit():
+        return None, int(tokens[1])
+    if len(tokens) == 3 and tokens[0] == "!roomretrieve" and tokens[2].isdigit():
+        return tokens[1], int(tokens[2])
+    return None
+
+
+def is_message(text):
+    """True for a rendered message, as opposed to an error such as 'Message ID not found'."""
+    return text.startswith("[") and " said: " in text
+
+
+class MessageCache:
+    """Bounded LRU of rendered messages a client has seen, keyed by (room, id).
+
+    Posted messages never change and the server never reuses an id, so a cached message
+    stays correct for the whole connection. Retrievals are sent tagged and tracked until
+    their reply arrives; the listener thread fills the cache while the input thread reads
+    it, so every method takes the lock.
+    """
+
+    def __init__(self, capacity=MESSAGE_CACHE_SIZE):
+        self.capacity = capacity
+        self.messages = OrderedDict()
+        self.pending = {}  # reply tag -> (room, id)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            text = self.messages.get(key)
+            if text is None:
+                self.misses += 1
+                return None
+            self.messages.move_to_end(key)
+            self.hits += 1
+            return text
+
+    def put(self, key, text):
+        if self.capacity <= 0:
+            return
+        with self.lock:
+            self.messages[key] = text
+            self.messages.move_to_end(key)
+            if len(self.messages) > self.capacity:
+                self.messages.popitem(last=False)
+
+    def track(self, tag, key):
+        """Remember which message a tagged retrieval asked for."""
+        with self.lock:
+            self.pending[tag] = key
+
+    def resolve(self, tag, text):
+        """Cache the reply to a tracked retrieval if it is a message."""
+        with self.lock:
+            key = self.pending.pop(tag, None)
+        if key is not None and is_message(text):
+            self.put(key, text)
+
+    def clear(self):
+        """Forget everything, e.g. on reconnecting to a server that may have restarted."""
+        with self.lock:
+            self.messages.clear()
+            self.pending.clear()
@@ -0,0 +1,82 @@
+import gzip
+import itertools
+import struct
+import threading
+import time
+
+# Capture files start with this line, followed by records of RECORD plus the command text.
+# A path ending in .gz is written and read through gzip.
+MAGIC = b"BBSCAP1\n"
+# Microseconds since the capture started, connection number, record kind, text length
+RECORD = struct.Struct("<QIBH")
+OPEN, COMMAND, CLOSE = range(3)
+
+# Buffered records are written out at least this often, so a killed server loses little
+FLUSH_INTERVAL = 1.0
+
+
+def _open(path, mode):
+    return gzip.open(path, mode) if path.endswith(".gz") else open(path, mode)
+
+
+class CaptureWriter:
+    """Records when each connection opens and closes and every command it sends.
+
+    Commands are stored as text without their reply tags, whichever protocol the client
+    spoke. Thread-safe; connections are numbered from 1 in the order they open.
+    """
+
+    def __init__(self, path):
+        self.file = _open(path, "wb")
+        self.file.write(MAGIC)
+        self.lock = threading.Lock()
+        self.connections = itertools.count(1)
+        self.started = time.monotonic()
+        self.flushed = self.started
+
+    def open(self):
+        """Record a new connection and return its number."""
+        conn_id = next(self.connections)
+        self._write(conn_id, OPEN, b"")
+        return conn_id
+
+    def command(self, conn_id, command):
+        self._write(conn_id, COMMAND, command.encode()[:0xFFFF])
+
+    def closed(self, conn_id):
+        self._write(conn_id, CLOSE, b"")
+
+    def _write(self, conn_id, kind, payload):
+        now = time.monotonic()
+        record = RECORD.pack(int((now - self.started) * 1e6), conn_id, kind, len(payload)) + payload
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(record)
+            if now - self.flushed >= FLUSH_INTERVAL:
+                self.file.flush()
+                self.flushed = now
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_capture(path):
+    """Yield (seconds, connection, kind, command) for every record in a capture file."""
+    with _open(path, "rb") as capture:
+        if capture.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a capture file.")
+        while True:
+            # A server that was killed may leave a partial record, or gzip stream, at the end.
+            try:
+                header = capture.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    return
+                micros, conn_id, kind, length = RECORD.unpack(header)
+                payload = capture.read(length)
+            except EOFError:
+                return
+            if len(payload) < length:
+                return
+            yield micros / 1e6, conn_id, kind, payload.decode(errors="replace")
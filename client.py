@@ -1,6 +1,13 @@
+import argparse
+import asyncio
+import itertools
 import socket
 import threading
 import sys
+import time
+
+from cache import CACHE_HIT, MESSAGE_CACHE_SIZE, MessageCache, retrieval_key
+from protocol import RECV_SIZE, BinaryClient, ReplyReader, ServerStream, encode_command
 
 # Connection configuration
 SERVER_ADDRESS = '127.0.0.1'
@@ -13,25 +20,39 @@ VALID_COMMANDS = {
     "!retrieve",
     "!active",
     "!rooms",
+    "!createroom",
     "!joinroom",
     "!roommsg",
     "!roomretrieve",
+    "!search",
+    "!history",
     "!roomusers",
     "!leaveroom",
+    "!presence",
+    "!stats",
     "!quit",
     "!help",
 }
 
 client_socket = None
+# BinaryClient codec once the binary protocol has been negotiated
+codec = None
+# Messages already seen, so repeated retrievals are answered locally; retrievals are tagged
+# so their replies can be matched and cached
+cache = MessageCache()
+reply_tags = itertools.count(1)
 
 
-def listen_for_responses(sock):
+def listen_for_responses(sock, stream, reader):
     """Continuously listen for messages from the server."""
     while True:
         try:
-            server_response = sock.recv(1024).decode()
-            if server_response:
-                print(server_response, end="")
+            data = stream.recv()
+            if data:
+                for tag, server_response in reader.feed(data):
+                    if tag is not None:
+                        cache.resolve(tag, server_response)
+                    print(server_response, end="")
             else:
                 print("Connection to server closed.")
                 sock.close()
@@ -42,79 +63,308 @@ def listen_for_responses(sock):
             break
 
 
-def main():
-    global client_socket
-    print("Welcome to the Interactive Bulletin Board Terminal Client!")
-    print("Use '!help' to see available commands.")
+# Argument-count checks for commands that take parameters
+USAGE_RULES = {
+    "!register": (lambda n: n == 2, "Usage: !register [username]"),
+    "!send": (lambda n: n >= 2, "Usage: !send [message]"),
+    "!retrieve": (lambda n: n == 2, "Usage: !retrieve [id]"),
+    "!rooms": (lambda n: n <= 3, "Usage: !rooms [prefix] [page]"),
+    "!createroom": (lambda n: n == 2, "Usage: !createroom [room]"),
+    "!joinroom": (lambda n: n == 2, "Usage: !joinroom [room]"),
+    "!roommsg": (lambda n: n >= 3, "Usage: !roommsg [room] [message]"),
+    "!roomretrieve": (lambda n: n == 3, "Usage: !roomretrieve [room] [id]"),
+    "!history": (lambda n: 2 <= n <= 4, "Usage: !history [room|public] [since-id] [limit]"),
+    "!search": (lambda n: n >= 3, "Usage: !search [room|public] [terms]"),
+    "!roomusers": (lambda n: n == 2, "Usage: !roomusers [room]"),
+    "!leaveroom": (lambda n: n == 2, "Usage: !leaveroom [room]"),
+    "!presence": (lambda n: n in (2, 3), "Usage: !presence [public|room] [on|off]"),
+}
 
-    while True:
-        user_input = input().strip()
-        if not user_input:
-            continue
+# Number of scripted commands sent per write in batch mode
+BATCH_SIZE = 500
 
-        args = user_input.split()
-        command = args[0]
+# Commands the pipelined mode keeps in flight before waiting for replies
+PIPELINE_WINDOW = 256
+# Seconds the pipelined mode waits for the server to close after the final !quit
+QUIT_TIMEOUT = 5.0
 
-        if command not in VALID_COMMANDS:
-            print(f"Unknown command: {command}. Use '!help' for a list of valid commands.")
-            continue
 
-        if command == "!register" and len(args) != 2:
-            print("Usage: !register [username]")
-            continue
+def validate_command(args):
+    """Return an error message if the command is malformed, otherwise None."""
+    command = args[0]
+    if command not in VALID_COMMANDS:
+        return f"Unknown command: {command}. Use '!help' for a list of valid commands."
+    if command in USAGE_RULES:
+        is_valid, usage = USAGE_RULES[command]
+        if not is_valid(len(args)):
+            return usage
+    return None
 
-        if command == "!send" and len(args) < 2:
-            print("Usage: !send [message]")
-            continue
 
-        if command == "!retrieve" and len(args) != 2:
-            print("Usage: !retrieve [id]")
-            continue
+def encode_commands(commands):
+    """Frame commands in whichever protocol the connection speaks."""
+    if codec:
+        return b"".join(codec.encode(command)[1] for command in commands)
+    return b"".join(encode_command(command) for command in commands)
 
-        if command == "!joinroom" and len(args) != 2:
-            print("Usage: !joinroom [room]")
-            continue
 
-        if command == "!roommsg" and len(args) < 3:
-            print("Usage: !roommsg [room] [message]")
+def send_command(command):
+    """Send one typed command, answering a retrieval from the message cache when it can."""
+    key = retrieval_key(command.split())
+    if key is None:
+        client_socket.sendall(encode_commands([command]))
+        return
+    text = cache.get(key)
+    if text is not None:
+        print(CACHE_HIT + text, end="")
+        return
+    if codec:
+        tag, frame = codec.encode(command)
+    else:
+        tag = next(reply_tags)
+        frame = encode_command(command, tag)
+    cache.track(tag, key)
+    client_socket.sendall(frame)
+
+
+def open_server(binary=False, compress=False):
+    """Connect and negotiate any requested upgrades on a blocking socket.
+
+    Returns the socket, its ServerStream and the parser for replies: a BinaryClient once
+    the binary protocol is on, otherwise a ReplyReader.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect((SERVER_ADDRESS, SERVER_PORT))
+    print(f"Connected to server at {SERVER_ADDRESS}:{SERVER_PORT}")
+    stream = ServerStream(sock)
+    reader = ReplyReader()
+    # Compression has to be negotiated first; the binary acknowledgement then arrives compressed.
+    for command, wanted, name in (("!compress", compress, "compression"), ("!binary", binary, "the binary protocol")):
+        if not wanted:
             continue
+        accepted, banner = stream.negotiate(command)
+        print(banner, end="")
+        if not accepted:
+            print(f"The server does not support {name}; continuing without it.")
+        elif command == "!binary":
+            reader = BinaryClient()
+    return sock, stream, reader
+
 
-        if command == "!roomretrieve" and len(args) != 3:
-            print("Usage: !roomretrieve [room] [id]")
+def connect(binary=False, compress=False):
+    """Open the server connection, negotiate any requested upgrades and start the response listener."""
+    global client_socket, codec
+    try:
+        client_socket, stream, reader = open_server(binary, compress)
+        # Ids restart if the server restarted without --data-dir.
+        cache.clear()
+        if isinstance(reader, BinaryClient):
+            codec = reader
+            codec.messages = cache
+        listener = threading.Thread(target=listen_for_responses, args=(client_socket, stream, reader), daemon=True)
+        listener.start()
+        return listener
+    except Exception as e:
+        print(f"Failed to connect to server: {e}")
+        sys.exit()
+
+
+def read_commands(lines):
+    """Return the valid commands among scripted input lines, reporting the rest."""
+    commands = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        error = validate_command(line.split())
+        if error:
+            print(error)
             continue
+        commands.append(line)
+    return commands
+
+
+def run_batch(lines, binary=False, compress=False):
+    """Send piped commands in large framed batches instead of one write per command."""
+    commands = read_commands(lines)
+    if not commands:
+        return
+
+    listener = connect(binary, compress)
+    for start in range(0, len(commands), BATCH_SIZE):
+        client_socket.sendall(encode_commands(commands[start:start + BATCH_SIZE]))
+    if commands[-1].split()[0] != "!quit":
+        client_socket.sendall(encode_commands(["!quit"]))
+    # The server closes the connection once it has answered everything before !quit.
+    listener.join()
 
-        if command == "!roomusers" and len(args) != 2:
-            print("Usage: !roomusers [room]")
+
+async def run_pipeline(lines, binary=False, compress=False, window=PIPELINE_WINDOW, quiet=False):
+    """Send scripted commands without waiting for each reply, then report per-command timings.
+
+    Every command is tagged so its reply can be matched to it while broadcasts arrive in
+    between. At most `window` commands are in flight at once; each is timed from its write
+    to the first part of its reply. The summary goes to stderr so replies can be piped.
+    """
+    commands = read_commands(lines)
+    # The pipeline ends with its own !quit once every reply is in.
+    commands = list(itertools.takewhile(lambda command: command.split()[0] != "!quit", commands))
+    try:
+        sock, stream, parser = open_server(binary, compress)
+    except OSError as e:
+        print(f"Failed to connect to server: {e}")
+        return
+    binary_codec = parser if isinstance(parser, BinaryClient) else None
+    # Binary request ids are 16 bits, so the window must not let them wrap onto a pending one.
+    window = max(1, min(window, 0xFFFF))
+    reader, writer = await asyncio.open_connection(sock=sock)
+    slots = asyncio.Semaphore(window)
+    pending = {}  # tag -> (command name, time sent)
+    timings = {}
+    idle = asyncio.Event()
+    idle.set()
+    closed = asyncio.Event()
+
+    async def listen():
+        try:
+            await receive()
+        finally:
+            # Wake a sender waiting for a slot; no more replies will free one.
+            closed.set()
+            for _ in range(window):
+                slots.release()
+
+    async def receive():
+        # Whatever arrived with the last upgrade acknowledgement is already plain.
+        data = stream.pending
+        while True:
+            now = time.perf_counter()
+            for tag, text in parser.feed(data):
+                if not quiet:
+                    print(text, end="")
+                # Streamed replies arrive in several parts; the first one is timed.
+                if tag in pending:
+                    name, sent = pending.pop(tag)
+                    timings.setdefault(name, []).append(now - sent)
+                    slots.release()
+                    if not pending:
+                        idle.set()
+            chunk = await reader.read(RECV_SIZE)
+            if not chunk:
+                return
+            data = stream.decompressor.feed(chunk) if stream.decompressor else chunk
+
+    listener = asyncio.get_running_loop().create_task(listen())
+    started = time.perf_counter()
+    sent = 0
+    for command in commands:
+        await slots.acquire()
+        if closed.is_set():
+            break
+        if binary_codec:
+            tag, frame = binary_codec.encode(command)
+        else:
+            tag = next(reply_tags)
+            frame = encode_command(command, tag)
+        pending[tag] = (command.split()[0], time.perf_counter())
+        idle.clear()
+        writer.write(frame)
+        sent += 1
+        try:
+            await writer.drain()
+        except (ConnectionError, OSError):
+            break
+    # Either every reply arrives or the server closes the connection first.
+    await asyncio.wait([asyncio.ensure_future(idle.wait()), listener], return_when=asyncio.FIRST_COMPLETED)
+    elapsed = time.perf_counter() - started
+    if not listener.done():
+        writer.write(binary_codec.encode("!quit")[1] if binary_codec else encode_command("!quit"))
+        await asyncio.wait([listener], timeout=QUIT_TIMEOUT)
+    listener.cancel()
+    writer.close()
+    print_timings(timings, sent, len(pending), elapsed)
+    if sent < len(commands):
+        print(f"The server closed the connection; {len(commands) - sent} commands were not sent.", file=sys.stderr)
+
+
+def print_timings(timings, sent, unanswered, elapsed):
+    answered = sum(len(samples) for samples in timings.values())
+    rate = f" ({answered / elapsed:.0f}/s)" if elapsed else ""
+    print(f"{answered} of {sent} commands answered in {elapsed:.3f}s{rate}"
+          + (f", {unanswered} unanswered" if unanswered else ""), file=sys.stderr)
+    print(f"  {'':14} {'count':>8} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}", file=sys.stderr)
+    for name, samples in sorted(timings.items()):
+        samples.sort()
+        p50 = samples[(len(samples) - 1) // 2]
+        p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+        print(f"  {name:14} {len(samples):>8} {p50 * 1000:>9.2f} {p99 * 1000:>9.2f} {samples[-1] * 1000:>9.2f}",
+              file=sys.stderr)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Interactive Bulletin Board terminal client")
+    parser.add_argument("--binary", action="store_true",
+                        help="Use the compact binary protocol when the server supports it.")
+    parser.add_argument("--compress", action="store_true",
+                        help="Ask the server to compress what it sends, to save bandwidth on slow links.")
+    parser.add_argument("--cache-size", type=int, default=MESSAGE_CACHE_SIZE,
+                        help="Messages remembered to answer repeated !retrieve and !roomretrieve locally; 0 disables it.")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Send commands from --script or stdin without waiting for each reply, then report timings.")
+    parser.add_argument("--script", metavar="PATH",
+                        help="File of commands, one per line, for --pipeline (implies it); defaults to stdin.")
+    parser.add_argument("--window", type=int, default=PIPELINE_WINDOW,
+                        help="Commands --pipeline keeps in flight before waiting for replies.")
+    parser.add_argument("--quiet", action="store_true",
+                        help="With --pipeline, print only the timing summary, not the server's replies.")
+    return parser.parse_args(argv)
+
+
+def main():
+    global client_socket, cache
+    args = parse_args()
+    cache = MessageCache(args.cache_size)
+    if args.pipeline or args.script:
+        with (open(args.script) if args.script else sys.stdin) as lines:
+            asyncio.run(run_pipeline(lines, args.binary, args.compress, args.window, args.quiet))
+        return
+    if not sys.stdin.isatty():
+        run_batch(sys.stdin, args.binary, args.compress)
+        return
+
+    print("Welcome to the Interactive Bulletin Board Terminal Client!")
+    print("Use '!help' to see available commands.")
+
+    while True:
+        user_input = input().strip()
+        if not user_input:
             continue
 
-        if command == "!leaveroom" and len(args) != 2:
-            print("Usage: !leaveroom [room]")
+        tokens = user_input.split()
+        command = tokens[0]
+
+        error = validate_command(tokens)
+        if error:
+            print(error)
             continue
 
         # Connect to the server
         if command == "!help":
-            print("""Available Commands:\n!register [username]: Join the server.\n!send [message]: Post a public message.\n!retrieve [id]: Get a public message by ID.\n!active: List active users.\n!rooms: Show available chat rooms.\n!joinroom [room]: Join a chat room.\n!roommsg [room] [message]: Send a message to a chat room.\n!roomretrieve [room] [id]: Retrieve a message from a chat room.\n!roomusers [room]: List chat room users.\n!leaveroom [room]: Leave a chat room.\n!quit: Disconnect from the server.""")
+            print("""Available Commands:\n!register [username]: Join the server.\n!send [message]: Post a public message.\n!retrieve [id]: Get a public message by ID.\n!active: List active users.\n!rooms [prefix] [page]: Show chat rooms, optionally filtered by prefix.\n!createroom [room]: Create a chat room.\n!joinroom [room]: Join a chat room.\n!roommsg [room] [message]: Send a message to a chat room.\n!roomretrieve [room] [id]: Retrieve a message from a chat room.\n!history [room|public] [since-id] [limit]: Stream messages after an ID.\n!search [room|public] [terms]: Find matching message IDs.\n!roomusers [room]: List chat room users.\n!leaveroom [room]: Leave a chat room.\n!presence [public|room] [on|off]: Follow who joins and leaves.\n!stats: Show server statistics.\n!quit: Disconnect from the server.""")
             continue
 
         if command == "!quit":
             if client_socket:
-                client_socket.sendall(command.encode())
+                client_socket.sendall(encode_commands([command]))
                 client_socket.close()
             print("Disconnected from server.")
             break
 
         if not client_socket:
-            try:
-                client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                client_socket.connect((SERVER_ADDRESS, SERVER_PORT))
-                print(f"Connected to server at {SERVER_ADDRESS}:{SERVER_PORT}")
-                threading.Thread(target=listen_for_responses, args=(client_socket,), daemon=True).start()
-            except Exception as e:
-                print(f"Failed to connect to server: {e}")
-                sys.exit()
+            connect(args.binary, args.compress)
 
         try:
-            client_socket.sendall(user_input.encode())
+            send_command(user_input)
         except Exception as e:
             print(f"Error sending data: {e}")
             client_socket.close()
@@ -0,0 +1,2 @@
+# The modules live at the top of the repository; pytest puts this directory on sys.path
+# so tests/ can import them as plain modules.
@@ -0,0 +1,347 @@
+import asyncio
+import queue
+import socket
+import threading
+import time
+
+import metrics
+from protocol import OP_SERVER_TEXT, Compressor, FrameBuffer, encode_frame
+
+# Default number of pending outbound messages a connection may hold before new ones are dropped
+OUTBOUND_QUEUE_SIZE = 256
+
+# How long close() waits for room in a full queue before forcing the socket shut
+CLOSE_TIMEOUT = 2.0
+
+# How often a reply waiting for room in a full queue checks that the writer is still running
+PUT_POLL_INTERVAL = 0.1
+
+# After the first pending message, how long a writer keeps collecting more before one write
+FLUSH_WINDOW = 0.001
+
+# Most buffers handed to a single sendmsg call; kept well under the usual IOV_MAX of 1024
+MAX_WRITE_BUFFERS = 512
+
+# Last thing queued for a client whose backlog reached the high-water mark
+OVERLOAD_NOTICE = "Disconnected: too many server messages were waiting for you to read them.\n"
+
+
+class StartCompression:
+    """Outbound queue marker: everything queued after it goes through the connection's compressor.
+
+    The acknowledgement travels inside the marker so nothing another thread queues can
+    land between it and the switch.
+    """
+
+    def __init__(self, threshold, ack=b""):
+        self.threshold = threshold
+        self.ack = ack
+
+
+def encode_notice(connection, text):
+    """Encode unsolicited server text in whichever protocol the connection speaks."""
+    notice = text.encode()
+    return encode_frame(OP_SERVER_TEXT, 0, notice) if connection.binary else notice
+
+
+def compress_batch(connection, batch):
+    """Apply a connection's stream compression to one writer batch, starting it at a marker."""
+    if connection.compressor is None and not connection.compression_requested:
+        return batch
+    buffers, plain = [], []
+    for item in batch:
+        if isinstance(item, StartCompression):
+            buffers += plain
+            buffers.append(item.ack)
+            plain = []
+            connection.compressor = Compressor(item.threshold)
+        else:
+            plain.append(item)
+    if plain:
+        buffers += connection.compressor.pack(plain) if connection.compressor else plain
+    return buffers
+
+
+class Connection:
+    """Per-client state shared by the threaded and the event-loop connection classes.
+
+    Subclasses supply the outbound queue and the writer that drains it.
+    """
+
+    def __init__(self, outbound, high_water=0):
+        # Parser for incoming bytes; replaced when the client negotiates the binary protocol,
+        # after which interned holds the (kind, id) pairs already announced to it
+        self.frames = FrameBuffer()
+        self.binary = False
+        self.interned = set()
+        # Rooms this client has joined, so disconnecting does not scan every room
+        self.rooms = set()
+        # Presence scopes this client subscribed to with !presence
+        self.subscriptions = set()
+        # Token bucket limiting this client's !send and !roommsg; set by the server, None is unlimited
+        self.send_bucket = None
+        # Number of this connection in the server's --capture file
+        self.capture_id = None
+        # Set before a StartCompression marker is queued; only the writer touches the compressor
+        self.compression_requested = False
+        self.compressor = None
+        self.outbound = outbound
+        self.high_water = high_water
+        # Broadcasts queued but not yet taken by the writer. The high-water mark applies to
+        # these alone, so a client's own pipelined replies never count against it.
+        self.broadcasts = 0
+        self.broadcasts_lock = threading.Lock()
+        self.closed = False
+        self.dropped = 0
+
+    def _count_broadcasts(self, change):
+        with self.broadcasts_lock:
+            self.broadcasts += change
+
+    def _taken(self, item):
+        """Unwrap an item the writer took from the queue, counting a broadcast as no longer pending.
+
+        Non-blocking sends queue their data as a 1-tuple so the writer can tell broadcasts
+        from replies, which are queued bare.
+        """
+        if type(item) is tuple:
+            self._count_broadcasts(-1)
+            return item[0]
+        return item
+
+
+class ClientConnection(Connection):
+    """Owns a client socket and a bounded outbound queue drained by a dedicated writer thread.
+
+    With a high_water mark, a broadcast that finds that many broadcasts already pending
+    disconnects the client instead of being dropped; it must be below max_pending so the
+    notice and the close marker still fit.
+    """
+
+    def __init__(self, sock, max_pending=OUTBOUND_QUEUE_SIZE, high_water=0):
+        super().__init__(queue.Queue(maxsize=max_pending), high_water)
+        self.sock = sock
+        self.writer = threading.Thread(target=self._drain, daemon=True)
+        self.writer.start()
+
+    def send(self, data, block=False):
+        """Queue data for delivery. Returns False if the connection is closed or its queue is full.
+
+        A blocking send waits for room only while the connection is open, so a writer that
+        died on a send error cannot leave the caller stuck on a queue nobody drains.
+        """
+        if self.closed:
+            return False
+        if not block and self.high_water and self.broadcasts >= self.high_water:
+            self.shed()
+            return False
+        while block:
+            try:
+                self.outbound.put(data, timeout=PUT_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                if self.closed:
+                    return False
+        try:
+            self.outbound.put_nowait((data,))
+        except queue.Full:
+            self.dropped += 1
+            if metrics.enabled:
+                metrics.outbound_dropped.inc()
+            return False
+        self._count_broadcasts(1)
+        return True
+
+    def recv(self, size):
+        return self.sock.recv(size)
+
+    def _collect(self):
+        """Block for one pending message, then gather whatever else arrives within FLUSH_WINDOW."""
+        batch = [self._taken(self.outbound.get())]
+        deadline = time.monotonic() + FLUSH_WINDOW
+        while batch[-1] is not None and len(batch) < MAX_WRITE_BUFFERS:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._taken(self.outbound.get(timeout=remaining)))
+                else:
+                    batch.append(self._taken(self.outbound.get_nowait()))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, buffers):
+        """Send several buffers with as few syscalls as possible."""
+        if metrics.enabled:
+            metrics.outbound_bytes.inc(sum(len(data) for data in buffers))
+        if not hasattr(self.sock, "sendmsg"):
+            self.sock.sendall(b"".join(buffers))
+            return
+        views = [memoryview(data) for data in buffers]
+        first = 0
+        while first < len(views):
+            sent = self.sock.sendmsg(views[first:first + MAX_WRITE_BUFFERS])
+            while sent:
+                if sent >= len(views[first]):
+                    sent -= len(views[first])
+                    first += 1
+                else:
+                    views[first] = views[first][sent:]
+                    sent = 0
+
+    def _drain(self):
+        """Write queued data to the socket until close() or a send error."""
+        while True:
+            batch = self._collect()
+            finished = batch[-1] is None
+            if finished:
+                batch.pop()
+            try:
+                batch = compress_batch(self, batch)
+                if batch:
+                    self._write(batch)
+            except OSError:
+                break
+            if finished:
+                break
+        self.closed = True
+        try:
+            # Shutting down first wakes a reader thread still blocked in recv().
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def shed(self):
+        """Disconnect a client that fell behind the high-water mark, telling it why.
+
+        Reading stops at once; the writer gets CLOSE_TIMEOUT to flush the backlog and the
+        notice before the socket is cut.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if metrics.enabled:
+            metrics.clients_shed.inc()
+        for item in (encode_notice(self, OVERLOAD_NOTICE), None):
+            try:
+                self.outbound.put_nowait(item)
+            except queue.Full:
+                pass
+        try:
+            self.sock.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+        timer = threading.Timer(CLOSE_TIMEOUT, self._abort)
+        timer.daemon = True
+        timer.start()
+
+    def _abort(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        """Stop accepting data, flush what is already queued, then close the socket."""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.outbound.put(None, timeout=CLOSE_TIMEOUT)
+        except queue.Full:
+            # The peer is not reading; fail the writer's pending send so it exits.
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class AsyncConnection(Connection):
+    """Event-loop counterpart of ClientConnection, drained by a writer task instead of a thread."""
+
+    def __init__(self, writer, max_pending=OUTBOUND_QUEUE_SIZE, high_water=0):
+        super().__init__(asyncio.Queue(maxsize=max_pending), high_water)
+        self.writer = writer
+        self.task = asyncio.get_running_loop().create_task(self._drain())
+
+    def send(self, data, block=False):
+        """Queue data for delivery. Never waits, since handlers run on the event loop thread."""
+        if self.closed:
+            return False
+        if self.high_water and self.broadcasts >= self.high_water:
+            self.shed()
+            return False
+        try:
+            self.outbound.put_nowait((data,))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if metrics.enabled:
+                metrics.outbound_dropped.inc()
+            return False
+        self._count_broadcasts(1)
+        return True
+
+    async def reply(self, data):
+        """Queue a direct response, waiting for room instead of dropping it."""
+        if not self.closed:
+            await self.outbound.put(data)
+
+    def shed(self):
+        """Disconnect a client that fell behind the high-water mark, telling it why.
+
+        The writer gets CLOSE_TIMEOUT to flush the backlog and the notice; after that the
+        transport is aborted, which also ends the reading side.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if metrics.enabled:
+            metrics.clients_shed.inc()
+        for item in (encode_notice(self, OVERLOAD_NOTICE), None):
+            try:
+                self.outbound.put_nowait(item)
+            except asyncio.QueueFull:
+                pass
+        asyncio.get_running_loop().call_later(CLOSE_TIMEOUT, self.writer.transport.abort)
+
+    async def _drain(self):
+        # Everything queued during one pass of the event loop is flushed together, so no
+        # extra flush window is needed here; the transport joins the buffers into one send.
+        try:
+            while True:
+                batch = [self._taken(await self.outbound.get())]
+                while batch[-1] is not None and not self.outbound.empty():
+                    batch.append(self._taken(self.outbound.get_nowait()))
+                finished = batch[-1] is None
+                if finished:
+                    batch.pop()
+                batch = compress_batch(self, batch)
+                if metrics.enabled:
+                    metrics.outbound_bytes.inc(sum(len(data) for data in batch))
+                self.writer.writelines(batch)
+                await self.writer.drain()
+                if finished:
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.closed = True
+            self.writer.close()
+            # Nothing will be written any more; emptying the queue wakes a reply() waiting for room.
+            while not self.outbound.empty():
+                self.outbound.get_nowait()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.outbound.put_nowait(None)
+        except asyncio.QueueFull:
+            # The peer is not reading; drop what is pending rather than wait on it.
+            self.task.cancel()
+            self.writer.close()
@@ -1,11 +1,30 @@
 import tkinter as tk
 from tkinter import scrolledtext, messagebox
+import itertools
+import queue
 import socket
 import threading
 
+from cache import CACHE_HIT, MESSAGE_CACHE_SIZE, MessageCache, retrieval_key
+from protocol import BinaryClient, ReplyReader, ServerStream, encode_batch, encode_command
+
 # Configuration
 SERVER_ADDRESS = '127.0.0.1'
 SERVER_PORT = 404
+# Ask the server for the compact binary protocol, falling back to text if it declines
+USE_BINARY_PROTOCOL = False
+# Ask the server to compress what it sends, which helps on slow or metered links
+USE_COMPRESSION = False
+
+# Rendering: received text is queued by the network thread and drawn by the Tk main loop
+# every RENDER_INTERVAL_MS, at most RENDER_BATCH messages per pass in a single insert.
+# Only the newest MAX_SCROLLBACK_LINES lines of each text area are kept.
+RENDER_INTERVAL_MS = 50
+RENDER_BATCH = 2000
+MAX_SCROLLBACK_LINES = 5000
+
+# Messages remembered to answer repeated !retrieve and !roomretrieve locally; 0 disables it
+CACHE_SIZE = MESSAGE_CACHE_SIZE
 
 class InteractiveGUI:
     def __init__(self):
@@ -17,6 +36,13 @@ class InteractiveGUI:
         # Socket
         self.client_socket = None
         self.is_connected = False
+        self.codec = None
+        self.stream = None
+        # (kind, text) pairs from the network thread, drawn by render_incoming on the main loop
+        self.incoming = queue.Queue()
+        # Messages already seen; retrievals are tagged so their replies can be matched and cached
+        self.cache = MessageCache(CACHE_SIZE)
+        self.reply_tags = itertools.count(1)
 
         # Main Frame
         self.main_frame = tk.Frame(self.window, bg="#222831")
@@ -60,6 +86,7 @@ class InteractiveGUI:
         self.quit_button.pack(side=tk.RIGHT, padx=5)
 
         self.display_feedback("Please Connect to the Server!")
+        self.window.after(RENDER_INTERVAL_MS, self.render_incoming)
 
 
     def connect_to_server(self):
@@ -71,8 +98,23 @@ class InteractiveGUI:
         try:
             self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.client_socket.connect((SERVER_ADDRESS, SERVER_PORT))
+            self.stream = ServerStream(self.client_socket)
+            self.codec = None
+            # Ids restart if the server restarted without --data-dir.
+            self.cache.clear()
+            upgrades = []
+            # Compression has to be negotiated first; the binary acknowledgement then arrives compressed.
+            for command, wanted, name in (("!compress", USE_COMPRESSION, "compressed"), ("!binary", USE_BINARY_PROTOCOL, "binary protocol")):
+                if wanted:
+                    accepted, banner = self.stream.negotiate(command)
+                    self.display_chat_message(banner)
+                    if accepted:
+                        upgrades.append(name)
+                        if command == "!binary":
+                            self.codec = BinaryClient()
+                            self.codec.messages = self.cache
             self.is_connected = True
-            self.display_feedback("Connected to the server.")
+            self.display_feedback(f"Connected to the server ({', '.join(upgrades)})." if upgrades else "Connected to the server.")
             threading.Thread(target=self.receive_messages, daemon=True).start()
         except Exception as e:
             messagebox.showerror("Connection Error", f"Unable to connect: {e}")
@@ -84,7 +126,7 @@ class InteractiveGUI:
             return
 
         try:
-            self.client_socket.sendall("!quit".encode())
+            self.client_socket.sendall(self.encode_commands(["!quit"]))
             self.client_socket.close()
         except:
             pass
@@ -102,39 +144,105 @@ class InteractiveGUI:
             self.display_feedback("Cannot send an empty message.")
             return
 
+        # Pasted multi-line input goes out as one pipelined batch of commands, minus the
+        # retrievals the message cache can answer.
+        commands = [line.strip() for line in msg.splitlines() if line.strip()]
+        sent, frames = [], []
+        for command in commands:
+            key = retrieval_key(command.split())
+            cached = self.cache.get(key) if key else None
+            if cached is not None:
+                self.display_chat_message(CACHE_HIT + cached)
+                self.display_feedback(f"Answered from the local cache: {command}")
+            else:
+                sent.append(command)
+                frames.append(self.encode_tracked(command, key))
         try:
-            self.client_socket.sendall(msg.encode())
-            self.display_feedback(f"Command sent: {msg}")
+            if frames:
+                self.client_socket.sendall(b"".join(frames))
+            for command in sent:
+                self.display_feedback(f"Command sent: {command}")
             self.message_input.delete(0, tk.END)
         except Exception as e:
             self.display_feedback(f"Error sending message: {e}")
 
+    def encode_commands(self, commands):
+        """Frame commands in whichever protocol the connection speaks."""
+        if self.codec:
+            return b"".join(self.codec.encode(command)[1] for command in commands)
+        return encode_batch(commands)
+
+    def encode_tracked(self, command, key):
+        """Frame one command; a retrieval is tagged so the message it returns can be cached."""
+        if key is None:
+            return self.encode_commands([command])
+        if self.codec:
+            tag, frame = self.codec.encode(command)
+        else:
+            tag = next(self.reply_tags)
+            frame = encode_command(command, tag)
+        self.cache.track(tag, key)
+        return frame
+
     def receive_messages(self):
-        """Continuously listen for messages from the server."""
+        """Continuously listen for messages from the server. Runs off the main thread, so it never touches widgets."""
+        reader = self.codec or ReplyReader()
         while self.is_connected:
             try:
-                server_msg = self.client_socket.recv(1024).decode()
-                if not server_msg:
+                data = self.stream.recv()
+                if not data:
                     break
-                self.display_chat_message(server_msg)
+                for tag, server_msg in reader.feed(data):
+                    if tag is not None:
+                        self.cache.resolve(tag, server_msg)
+                    self.incoming.put(("chat", server_msg))
             except Exception as e:
-                self.display_feedback(f"Connection error: {e}")
+                if self.is_connected:
+                    self.incoming.put(("feedback", f"Connection error: {e}"))
                 break
-        self.disconnect_from_server()
+        self.incoming.put(("closed", None))
+
+    def render_incoming(self):
+        """Draw queued server output on the main thread, one insert per text area per pass."""
+        chat, feedback = [], []
+        closed = False
+        try:
+            for _ in range(RENDER_BATCH):
+                kind, text = self.incoming.get_nowait()
+                if kind == "chat":
+                    chat.append(text + "\n")
+                elif kind == "feedback":
+                    feedback.append(text + "\n")
+                else:
+                    closed = True
+        except queue.Empty:
+            pass
+        if chat:
+            self.append_text(self.chat_display, "".join(chat))
+        if feedback:
+            self.append_text(self.command_feedback_area, "".join(feedback))
+        if closed and self.is_connected:
+            self.disconnect_from_server()
+        # Come straight back if a burst is still queued; otherwise wait for the next frame.
+        self.window.after(1 if not self.incoming.empty() else RENDER_INTERVAL_MS, self.render_incoming)
+
+    def append_text(self, area, text):
+        """Append to a read-only text area, trimming it to MAX_SCROLLBACK_LINES."""
+        area.config(state='normal')
+        area.insert(tk.END, text)
+        lines = int(area.index('end-1c').split('.')[0])
+        if lines > MAX_SCROLLBACK_LINES:
+            area.delete('1.0', f'{lines - MAX_SCROLLBACK_LINES + 1}.0')
+        area.config(state='disabled')
+        area.see(tk.END)
 
     def display_chat_message(self, message):
         """Display a message in the chat area."""
-        self.chat_display.config(state='normal')
-        self.chat_display.insert(tk.END, message + "\n")
-        self.chat_display.config(state='disabled')
-        self.chat_display.see(tk.END)
+        self.append_text(self.chat_display, message + "\n")
 
     def display_feedback(self, feedback):
         """Display feedback or error messages in the command feedback area."""
-        self.command_feedback_area.config(state='normal')
-        self.command_feedback_area.insert(tk.END, feedback + "\n")
-        self.command_feedback_area.config(state='disabled')
-        self.command_feedback_area.see(tk.END)
+        self.append_text(self.command_feedback_area, feedback + "\n")
 
     def quit_application(self):
         """Close the application."""
@@ -0,0 +1,38 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average, with bursts of up to `burst` at once.
+
+    Tokens refill continuously and are spent one per event; take() never blocks, so
+    handlers can turn a refusal into a reply instead of stalling the connection.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Spend one token. Returns 0 on success, otherwise the seconds until one is available."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def refund(self):
+        """Give back a token spent on an event that was refused by another limit."""
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + 1)
+
+
+def make_bucket(rate, burst):
+    """Return a bucket for a limit, or None when the rate is 0 and the limit is off."""
+    return TokenBucket(rate, burst) if rate > 0 else None
@@ -0,0 +1,223 @@
+"""Lightweight in-process metrics for the server.
+
+Everything is off until enable() is called. Call sites check the module-level `enabled`
+flag before doing any timing, so a disabled server pays one global lookup per hook.
+Metrics are exposed as Prometheus-style text through render() and serve_http().
+"""
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+enabled = False
+
+# Histogram bucket upper bounds in seconds (1us .. ~10s, four per decade)
+TIME_BUCKETS = [10 ** (exponent / 4) for exponent in range(-24, 5)]
+# Bucket upper bounds for size-like observations such as fan-out recipients
+SIZE_BUCKETS = [2 ** exponent for exponent in range(0, 17)]
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+class Counter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Gauge(Counter):
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+class Histogram:
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        slot = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[slot] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, fraction):
+        """Estimate a quantile as the upper bound of the bucket that contains it."""
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def samples(self, name, labels):
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            yield f"{name}_bucket", {**labels, "le": f"{bound:.6g}"}, seen
+        yield f"{name}_bucket", {**labels, "le": "+Inf"}, self.count
+        yield f"{name}_sum", labels, self.sum
+        yield f"{name}_count", labels, self.count
+
+
+class Family:
+    """A named metric, optionally split by the value of one label."""
+
+    def __init__(self, name, help_text, kind, factory, label=None):
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.factory = factory
+        self.label = label
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, value):
+        child = self.children.get(value)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(value, self.factory())
+        return child
+
+    def __getattr__(self, attribute):
+        # Unlabelled families act like their single child: family.inc(), family.observe(x).
+        return getattr(self.labels(None), attribute)
+
+
+def _family(name, help_text, kind, factory, label):
+    with _registry_lock:
+        if name not in _registry:
+            _registry[name] = Family(name, help_text, kind, factory, label)
+        return _registry[name]
+
+
+def counter(name, help_text, label=None):
+    return _family(name, help_text, "counter", Counter, label)
+
+
+def gauge(name, help_text, label=None):
+    return _family(name, help_text, "gauge", Gauge, label)
+
+
+def histogram(name, help_text, label=None, buckets=TIME_BUCKETS):
+    return _family(name, help_text, "histogram", lambda: Histogram(buckets), label)
+
+
+class TimedLock:
+    """A lock that records how long callers waited for it and how long they held it."""
+
+    def __init__(self, name):
+        self.lock = threading.Lock()
+        self.wait = lock_wait_seconds.labels(name)
+        self.hold = lock_hold_seconds.labels(name)
+        self.acquired_at = 0.0
+
+    def __enter__(self):
+        started = time.perf_counter()
+        self.lock.acquire()
+        self.acquired_at = time.perf_counter()
+        self.wait.observe(self.acquired_at - started)
+        return self
+
+    def __exit__(self, *exc_info):
+        held = time.perf_counter() - self.acquired_at
+        self.lock.release()
+        self.hold.observe(held)
+
+
+def make_lock(name):
+    """Return a timed lock while metrics are enabled, otherwise a plain one."""
+    return TimedLock(name) if enabled else threading.Lock()
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def _format_labels(labels):
+    labels = {key: value for key, value in labels.items() if value is not None}
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+def render():
+    """Render every metric in the Prometheus text exposition format."""
+    lines = []
+    for family in list(_registry.values()):
+        lines.append(f"# HELP {family.name} {family.help_text}")
+        lines.append(f"# TYPE {family.name} {family.kind}")
+        for value, child in sorted(family.children.items(), key=lambda item: str(item[0])):
+            labels = {family.label: value} if family.label else {}
+            for name, sample_labels, sample in child.samples(family.name, labels):
+                lines.append(f"{name}{_format_labels(sample_labels)} {sample:.6g}")
+    return "\n".join(lines) + "\n"
+
+
+def summary():
+    """A short human-readable digest for the !stats command."""
+    lines = []
+    for family in list(_registry.values()):
+        for value, child in sorted(family.children.items(), key=lambda item: str(item[0])):
+            name = family.name if value is None else f"{family.name}[{value}]"
+            if isinstance(child, Histogram):
+                if child.count:
+                    scale, unit = (1000, "ms") if child.buckets is TIME_BUCKETS else (1, "")
+                    lines.append(f"{name}: n={child.count} p50<={child.quantile(0.5) * scale:.3g}{unit} "
+                                 f"p99<={child.quantile(0.99) * scale:.3g}{unit}")
+            else:
+                lines.append(f"{name}: {child.value}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_http(host, port):
+    """Expose render() at http://host:port/metrics from a background thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Metrics shared by the server modules
+command_seconds = histogram("bbs_command_seconds", "Time spent handling each command.", label="command")
+commands_total = counter("bbs_commands_total", "Commands handled.", label="command")
+connections_open = gauge("bbs_connections_open", "Client connections currently open.")
+connections_total = counter("bbs_connections_total", "Client connections accepted.")
+rooms_loaded = gauge("bbs_rooms_loaded", "Rooms whose state is currently held in memory.")
+outbound_bytes = counter("bbs_outbound_bytes_total", "Bytes written to client sockets.")
+outbound_dropped = counter("bbs_outbound_dropped_total", "Broadcasts dropped because a client's queue was full.")
+clients_shed = counter("bbs_clients_shed_total", "Clients disconnected because their pending output reached the high-water mark.")
+rate_limited = counter("bbs_rate_limited_total", "Messages refused by a rate limit.", label="limit")
+admissions_refused = counter("bbs_admissions_refused_total", "Connections or registrations refused at a server cap.", label="cap")
+fanout_recipients = histogram("bbs_fanout_recipients", "Recipients per broadcast.", label="target", buckets=SIZE_BUCKETS)
+lock_wait_seconds = histogram("bbs_lock_wait_seconds", "Time spent waiting to acquire a state lock.", label="lock")
+lock_hold_seconds = histogram("bbs_lock_hold_seconds", "Time a state lock was held.", label="lock")
@@ -0,0 +1,60 @@
+import itertools
+import threading
+
+# Versions are drawn from one shared counter so concurrent invalidations never collide
+_versions = itertools.count(1)
+
+
+class RosterCache:
+    """Rendered member lists keyed by scope (None for the whole server, otherwise a room name).
+
+    A roster is rendered at most once per change: invalidate() bumps the scope's version and
+    get() re-renders only when the cached copy is older. The version is read before the
+    render, so a render racing a change is stored under the old version and redone next time.
+    """
+
+    def __init__(self):
+        self.versions = {}
+        self.rendered = {}
+
+    def invalidate(self, scope):
+        self.versions[scope] = next(_versions)
+
+    def forget(self, scope):
+        self.rendered.pop(scope, None)
+
+    def get(self, scope, render):
+        version = self.versions.get(scope, 0)
+        cached = self.rendered.get(scope)
+        if cached and cached[0] == version:
+            return cached[1]
+        text = render()
+        self.rendered[scope] = (version, text)
+        return text
+
+
+class Subscriptions:
+    """Connections that asked for presence updates, per scope.
+
+    Each scope's set is copy-on-write, so broadcasters iterate a stable snapshot without
+    taking the lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.scopes = {}  # scope -> {connection: connection}
+
+    def add(self, scope, connection):
+        with self.lock:
+            self.scopes[scope] = {**self.scopes.get(scope, {}), connection: connection}
+
+    def remove(self, scope, connection):
+        with self.lock:
+            remaining = {conn: conn for conn in self.scopes.get(scope, {}) if conn is not connection}
+            if remaining:
+                self.scopes[scope] = remaining
+            else:
+                self.scopes.pop(scope, None)
+
+    def get(self, scope):
+        return self.scopes.get(scope, {})
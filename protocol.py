@@ -0,0 +1,463 @@
+"""Wire protocol shared by the server and the clients.
+
+Every command is one line of UTF-8 text terminated by a newline, so a client may
+write any number of commands in a single send and the server parses all of them
+from its receive buffer. A command may be prefixed with '#<tag> ' to ask for a
+tagged reply, sent back as '#<tag> <length>' on its own line followed by exactly
+<length> bytes of response. Tags let pipelining clients match replies to commands
+even when broadcasts are interleaved with them; untagged commands get plain replies.
+"""
+import codecs
+import re
+import struct
+import threading
+import zlib
+from datetime import datetime
+
+FRAME_DELIMITER = b"\n"
+
+# Longest command line the server will buffer before giving up on the client
+MAX_FRAME_SIZE = 8192
+
+# Receive size used by the server and clients
+RECV_SIZE = 65536
+
+TAG_HEADER = re.compile(rb"#(\d{1,9}) (\d{1,9})\n")
+
+
+class FrameTooLarge(ValueError):
+    """Raised when a peer sends more than MAX_FRAME_SIZE bytes without a delimiter."""
+
+
+class FrameBuffer:
+    """Accumulates received bytes and splits them into complete command frames."""
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Add received bytes and return every complete, non-empty frame as text."""
+        self.buffer += data
+        end = self.buffer.rfind(FRAME_DELIMITER)
+        if end < 0:
+            if len(self.buffer) > self.max_frame_size:
+                raise FrameTooLarge(f"Command exceeds {self.max_frame_size} bytes.")
+            return []
+        complete = bytes(self.buffer[:end])
+        del self.buffer[:end + 1]
+        if len(self.buffer) > self.max_frame_size:
+            raise FrameTooLarge(f"Command exceeds {self.max_frame_size} bytes.")
+        frames = []
+        for line in complete.split(FRAME_DELIMITER):
+            # Checked per line too, so the limit does not depend on how TCP split the stream.
+            if len(line) > self.max_frame_size:
+                raise FrameTooLarge(f"Command exceeds {self.max_frame_size} bytes.")
+            line = line.strip()
+            if line:
+                frames.append(line.decode(errors="replace"))
+        return frames
+
+
+def encode_command(command, tag=None):
+    """Frame a single command, optionally tagged for reply correlation."""
+    command = " ".join(command.split())
+    if tag is not None:
+        command = f"#{tag} {command}"
+    return command.encode() + FRAME_DELIMITER
+
+
+def encode_batch(commands):
+    """Frame several commands into one buffer so they go out in a single write."""
+    return b"".join(encode_command(command) for command in commands)
+
+
+def split_tag(frame):
+    """Split an optional '#<tag> ' prefix off a received frame."""
+    if frame.startswith("#"):
+        tag, _, command = frame[1:].partition(" ")
+        if tag.isdigit():
+            return int(tag), command
+    return None, frame
+
+
+def encode_reply(tag, body):
+    """Encode a response body, wrapping it in a tag header when the command was tagged."""
+    if tag is None:
+        return body
+    return f"#{tag} {len(body)}\n".encode() + body
+
+
+class ReplyReader:
+    """Client-side parser that separates tagged replies from untagged server text."""
+
+    def __init__(self):
+        self.buffer = b""
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def feed(self, data):
+        """Return a list of (tag, text) pairs; tag is None for broadcasts and untagged replies."""
+        self.buffer += data
+        events = []
+        untagged = bytearray()
+        while self.buffer:
+            if self.buffer.startswith(b"#"):
+                header = TAG_HEADER.match(self.buffer)
+                if header:
+                    length = int(header.group(2))
+                    if len(self.buffer) < header.end() + length:
+                        break
+                    if untagged:
+                        events.append((None, self.decoder.decode(bytes(untagged))))
+                        untagged.clear()
+                    body = self.buffer[header.end():header.end() + length]
+                    self.buffer = self.buffer[header.end() + length:]
+                    events.append((int(header.group(1)), body.decode(errors="replace")))
+                    continue
+                if FRAME_DELIMITER not in self.buffer:
+                    # Could still be the start of a tag header; wait for the rest of the line.
+                    break
+            end = self.buffer.find(FRAME_DELIMITER)
+            if end < 0:
+                end = len(self.buffer) - 1
+            untagged += self.buffer[:end + 1]
+            self.buffer = self.buffer[end + 1:]
+        if untagged:
+            events.append((None, self.decoder.decode(bytes(untagged))))
+        return events
+
+
+# Binary protocol
+#
+# A client that sends the text command '!binary' and reads back the BINARY_ACK line
+# switches its connection to binary frames in both directions; a server that does not
+# know the command answers with ordinary text and the client stays on the text protocol.
+# The client must not send binary frames before it has read the acknowledgement.
+#
+# Each frame is BINARY_HEADER (opcode, request id, payload length) plus the payload.
+# Request id 0 marks unsolicited server frames such as broadcasts. Rooms and users are
+# referred to by numeric ids that the server announces with an INTERN frame before a
+# connection first sees them; public board messages use room id 0.
+BINARY_ACK = "BINARY OK"
+BINARY_HEADER = struct.Struct("!BHI")
+MAX_BINARY_PAYLOAD = MAX_FRAME_SIZE
+
+# Client opcodes and the commands they stand for; OP_TEXT carries any other text command
+OP_TEXT = 0
+BINARY_COMMANDS = {
+    "!register": 1,
+    "!send": 2,
+    "!retrieve": 3,
+    "!active": 4,
+    "!rooms": 5,
+    "!joinroom": 6,
+    "!roommsg": 7,
+    "!roomretrieve": 8,
+    "!roomusers": 9,
+    "!leaveroom": 10,
+    "!quit": 11,
+}
+COMMAND_NAMES = {opcode: command for command, opcode in BINARY_COMMANDS.items()}
+
+# Server opcodes
+OP_SERVER_TEXT = 0x80
+OP_MESSAGE = 0x81
+OP_INTERN = 0x82
+
+INTERN_USER = 0
+INTERN_ROOM = 1
+
+ID = struct.Struct("!I")
+ROOM_AND_ID = struct.Struct("!II")
+# Message frame: room id, message id, user id, timestamp in whole seconds
+MESSAGE_HEADER = struct.Struct("!IIII")
+INTERN_HEADER = struct.Struct("!BI")
+
+
+class Interner:
+    """Thread-safe mapping between names and small, never-reused numeric ids."""
+
+    def __init__(self, first_id=1):
+        self.lock = threading.Lock()
+        self.ids = {}
+        self.names = {}
+        self.next_id = first_id
+
+    def id_for(self, name):
+        found = self.ids.get(name)
+        if found is not None:
+            return found
+        with self.lock:
+            if name not in self.ids:
+                self.ids[name] = self.next_id
+                self.names[self.next_id] = name
+                self.next_id += 1
+            return self.ids[name]
+
+    def name_for(self, ident):
+        return self.names.get(ident)
+
+
+def encode_frame(opcode, req, payload=b""):
+    return BINARY_HEADER.pack(opcode, req, len(payload)) + payload
+
+
+def encode_intern(kind, ident, name):
+    return encode_frame(OP_INTERN, 0, INTERN_HEADER.pack(kind, ident) + name.encode())
+
+
+def encode_message(room_id, msg, user_id, req=0):
+    payload = MESSAGE_HEADER.pack(room_id, msg.msg_id or 0, user_id, int(msg.time)) + msg.text.encode()
+    return encode_frame(OP_MESSAGE, req, payload)
+
+
+class BinaryFrameBuffer:
+    """Server-side counterpart of FrameBuffer for binary connections."""
+
+    def __init__(self, initial=b"", max_payload=MAX_BINARY_PAYLOAD):
+        self.max_payload = max_payload
+        self.buffer = bytearray(initial)
+
+    def feed(self, data):
+        """Return every complete frame as (request id, opcode, payload)."""
+        self.buffer += data
+        frames = []
+        offset = 0
+        while len(self.buffer) - offset >= BINARY_HEADER.size:
+            opcode, req, length = BINARY_HEADER.unpack_from(self.buffer, offset)
+            if length > self.max_payload:
+                raise FrameTooLarge(f"Command exceeds {self.max_payload} bytes.")
+            end = offset + BINARY_HEADER.size + length
+            if end > len(self.buffer):
+                break
+            frames.append((req, opcode, bytes(self.buffer[offset + BINARY_HEADER.size:end])))
+            offset = end
+        del self.buffer[:offset]
+        return frames
+
+
+def decode_command(opcode, payload, rooms):
+    """Turn a binary command into the token list the text parser would have produced."""
+    if opcode == OP_TEXT:
+        return payload.decode(errors="replace").split()
+    command = COMMAND_NAMES.get(opcode)
+    if command is None:
+        return [f"!opcode{opcode}"]
+    if command in ("!register", "!send", "!joinroom"):
+        return [command, *payload.decode(errors="replace").split()]
+    if command == "!retrieve":
+        return [command, str(ID.unpack(payload)[0])]
+    if command == "!roommsg":
+        room_name = rooms.name_for(ID.unpack_from(payload)[0]) or ""
+        return [command, room_name, *payload[ID.size:].decode(errors="replace").split()]
+    if command == "!roomretrieve":
+        room_id, msg_id = ROOM_AND_ID.unpack(payload)
+        return [command, rooms.name_for(room_id) or "", str(msg_id)]
+    if command in ("!roomusers", "!leaveroom"):
+        return [command, rooms.name_for(ID.unpack(payload)[0]) or ""]
+    return [command]
+
+
+class BinaryClient:
+    """Client-side codec: encodes typed commands as binary frames and renders server frames as text."""
+
+    def __init__(self, initial=b""):
+        self.buffer = bytearray(initial)
+        self.rooms = {}  # room id -> name
+        self.room_ids = {}  # room name -> id
+        self.users = {}  # user id -> name
+        self.next_req = 0
+        # Optional MessageCache that broadcast message frames are added to, since they carry ids
+        self.messages = None
+
+    def encode(self, command):
+        """Return (request id, frame) for a text command, falling back to OP_TEXT when needed."""
+        self.next_req = self.next_req % 0xFFFF + 1
+        req = self.next_req
+        args = command.split()
+        opcode = BINARY_COMMANDS.get(args[0]) if args else None
+        try:
+            payload = self._payload(opcode, args)
+        except (KeyError, ValueError, IndexError, struct.error):
+            opcode, payload = None, None
+        if payload is None:
+            return req, encode_frame(OP_TEXT, req, " ".join(args).encode())
+        return req, encode_frame(opcode, req, payload)
+
+    def _payload(self, opcode, args):
+        command = args[0] if args else None
+        if opcode is None:
+            return None
+        if command in ("!register", "!joinroom") and len(args) == 2:
+            return args[1].encode()
+        if command == "!send" and len(args) >= 2:
+            return " ".join(args[1:]).encode()
+        if command == "!retrieve" and len(args) == 2:
+            return ID.pack(int(args[1]))
+        if command in ("!active", "!rooms", "!quit") and len(args) == 1:
+            return b""
+        if command == "!roommsg" and len(args) >= 3:
+            return ID.pack(self.room_ids[args[1]]) + " ".join(args[2:]).encode()
+        if command == "!roomretrieve" and len(args) == 3:
+            return ROOM_AND_ID.pack(self.room_ids[args[1]], int(args[2]))
+        if command in ("!roomusers", "!leaveroom") and len(args) == 2:
+            return ID.pack(self.room_ids[args[1]])
+        # Wrong argument count: let the server produce its usual usage message.
+        return None
+
+    def feed(self, data):
+        """Return (request id or None, text) pairs, like ReplyReader."""
+        self.buffer += data
+        events = []
+        offset = 0
+        while len(self.buffer) - offset >= BINARY_HEADER.size:
+            opcode, req, length = BINARY_HEADER.unpack_from(self.buffer, offset)
+            end = offset + BINARY_HEADER.size + length
+            if end > len(self.buffer):
+                break
+            payload = bytes(self.buffer[offset + BINARY_HEADER.size:end])
+            offset = end
+            text = self._render(opcode, req, payload)
+            if text is not None:
+                events.append((req or None, text))
+        del self.buffer[:offset]
+        return events
+
+    def _render(self, opcode, req, payload):
+        if opcode == OP_INTERN:
+            kind, ident = INTERN_HEADER.unpack_from(payload)
+            name = payload[INTERN_HEADER.size:].decode(errors="replace")
+            if kind == INTERN_ROOM:
+                self.rooms[ident] = name
+                self.room_ids[name] = ident
+            else:
+                self.users[ident] = name
+            return None
+        if opcode == OP_MESSAGE:
+            room_id, msg_id, user_id, timestamp = MESSAGE_HEADER.unpack_from(payload)
+            text = payload[MESSAGE_HEADER.size:].decode(errors="replace")
+            stamp = datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+            line = f"[{stamp}] {self.users.get(user_id, f'user#{user_id}')} said: {text}\n"
+            if self.messages is not None and not req and (not room_id or room_id in self.rooms):
+                self.messages.put((self.rooms.get(room_id), msg_id), line)
+            if room_id and not req:
+                line = f"Message in {self.rooms.get(room_id, f'room#{room_id}')}: {line}"
+            return line
+        return payload.decode(errors="replace")
+
+
+
+# Stream compression
+#
+# After the text command '!compress' the server answers COMPRESS_ACK as plain text and then
+# wraps everything it writes in blocks: BLOCK_HEADER (kind, body length) plus the body. Each
+# writer batch below the server's threshold goes out as a raw block so short replies are not
+# inflated by deflate overhead; larger ones are compressed with one zlib stream per
+# connection and Z_SYNC_FLUSH, so every block can be decoded as soon as it arrives and later
+# blocks still benefit from the history of earlier ones. Negotiate it before '!binary'.
+COMPRESS_ACK = "COMPRESS OK"
+COMPRESS_THRESHOLD = 256
+COMPRESS_LEVEL = 6
+BLOCK_HEADER = struct.Struct("!BH")
+BLOCK_RAW = 0
+BLOCK_DEFLATE = 1
+MAX_BLOCK = 0xFFFF
+
+
+class Compressor:
+    """Server-side half of a compressed connection."""
+
+    def __init__(self, threshold=COMPRESS_THRESHOLD, level=COMPRESS_LEVEL):
+        self.threshold = threshold
+        self.stream = zlib.compressobj(level)
+
+    def pack(self, buffers):
+        """Turn one batch of outgoing buffers into a list of blocks."""
+        data = b"".join(buffers)
+        if len(data) < self.threshold:
+            return self._blocks(BLOCK_RAW, data)
+        return self._blocks(BLOCK_DEFLATE, self.stream.compress(data) + self.stream.flush(zlib.Z_SYNC_FLUSH))
+
+    def _blocks(self, kind, body):
+        blocks = []
+        for start in range(0, len(body), MAX_BLOCK):
+            chunk = body[start:start + MAX_BLOCK]
+            blocks.append(BLOCK_HEADER.pack(kind, len(chunk)) + chunk)
+        return blocks
+
+
+class Decompressor:
+    """Client-side half of a compressed connection."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.stream = zlib.decompressobj()
+
+    def feed(self, data):
+        """Return the plain bytes carried by every complete block received so far."""
+        self.buffer += data
+        plain = []
+        offset = 0
+        while len(self.buffer) - offset >= BLOCK_HEADER.size:
+            kind, length = BLOCK_HEADER.unpack_from(self.buffer, offset)
+            end = offset + BLOCK_HEADER.size + length
+            if end > len(self.buffer):
+                break
+            body = bytes(self.buffer[offset + BLOCK_HEADER.size:end])
+            plain.append(self.stream.decompress(body) if kind == BLOCK_DEFLATE else body)
+            offset = end
+        del self.buffer[:offset]
+        return b"".join(plain)
+
+
+# Upgrade commands a client can send and the line that acknowledges each
+UPGRADES = {"!compress": COMPRESS_ACK, "!binary": BINARY_ACK}
+
+
+class ServerStream:
+    """Client-side view of what the server sends, undoing compression and handling upgrades."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.decompressor = None
+        self.pending = b""
+
+    def recv(self):
+        """Return the next chunk of the server's plain output, or b"" once the connection closes."""
+        while True:
+            if self.pending:
+                data, self.pending = self.pending, b""
+                return data
+            data = self.sock.recv(RECV_SIZE)
+            if not data or self.decompressor is None:
+                return data
+            data = self.decompressor.feed(data)
+            if data:
+                return data
+
+    def negotiate(self, command):
+        """Send an upgrade command on a blocking socket before any listener starts.
+
+        Returns (accepted, text) where text is everything the server said before answering,
+        such as its welcome banner. A server that does not know the command answers with
+        ordinary text and the connection carries on unchanged.
+        """
+        self.sock.sendall(encode_command(command))
+        ack = f"\n{UPGRADES[command]}\n".encode()
+        received = b"\n"
+        while True:
+            data = self.recv()
+            if not data:
+                return False, received[1:].decode(errors="replace")
+            received += data
+            found = received.find(ack)
+            if found >= 0:
+                rest = received[found + len(ack):]
+                if command == "!compress":
+                    # Nothing else was requested, so everything after the acknowledgement is blocks.
+                    self.decompressor = Decompressor()
+                    rest = self.decompressor.feed(rest)
+                self.pending = rest
+                return True, received[1:found + 1].decode(errors="replace")
+            if b"\nUnrecognized command" in received and received.endswith(b"\n"):
+                return False, received[1:].decode(errors="replace")
@@ -0,0 +1,211 @@
+"""Replay traffic recorded with `backend.py --capture` and measure the server's reply latency.
+
+Opens one connection per recorded connection and re-sends every command at its recorded
+offset, divided by --speed, without waiting for earlier replies, so the server sees the
+same load shape it saw when the capture was taken. Each command is tagged so its reply
+latency can be measured while broadcasts are interleaved. Like bench.py, it launches
+backend.py on a free local port unless --connect is given, and arguments after '--' are
+passed to the server.
+
+    python backend.py --capture incident.cap
+    python replay.py incident.cap --speed 4 --json new.json -- --mode async
+
+Replay always speaks the text protocol: recorded !binary and !compress commands are
+skipped, and commands from binary clients were already captured in text form.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from bench import Stats, free_port, launch_server, raise_fd_limit, summarize
+from capture import CLOSE, COMMAND, OPEN, read_capture
+from protocol import RECV_SIZE, ReplyReader, encode_command
+
+# Protocol upgrades the replayed text connections cannot follow
+SKIPPED = {"!binary", "!compress"}
+
+# Seconds a closing connection waits for replies still outstanding
+REPLY_TIMEOUT = 10.0
+
+
+def load_sessions(path):
+    """Group a capture by connection: {conn_id: [opened_at, [(offset, command), ...], closed_at]}."""
+    sessions = {}
+    for offset, conn_id, kind, command in read_capture(path):
+        if kind == OPEN:
+            sessions[conn_id] = [offset, [], None]
+        elif conn_id in sessions:
+            if kind == COMMAND:
+                sessions[conn_id][1].append((offset, command))
+            elif kind == CLOSE:
+                sessions[conn_id][2] = offset
+    return sessions
+
+
+class ReplayClient:
+    """One recorded connection, re-sending its commands on schedule and timing the tagged replies."""
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.pending = {}
+        self.next_tag = 0
+        self.lag = []
+        self.skipped = 0
+
+    async def run(self, host, port, session, start, speed):
+        opened_at, commands, closed_at = session
+        await self.sleep_until(start, opened_at, speed)
+        try:
+            self.reader, self.writer = await asyncio.open_connection(host, port)
+        except OSError:
+            self.stats.errors += 1
+            return
+        listener = asyncio.get_running_loop().create_task(self.listen())
+        try:
+            for offset, command in commands:
+                name = command.split()[0] if command.split() else ""
+                if name in SKIPPED:
+                    self.skipped += 1
+                    continue
+                self.lag.append(await self.sleep_until(start, offset, speed))
+                self.send(name, command)
+                if name == "!quit":
+                    break
+            if closed_at is not None:
+                await self.sleep_until(start, closed_at, speed)
+            if self.pending:
+                await asyncio.wait([reply for reply, _, _ in self.pending.values()], timeout=REPLY_TIMEOUT)
+        except (ConnectionError, OSError):
+            self.stats.errors += 1
+        finally:
+            self.stats.errors += sum(not reply.done() for reply, _, _ in self.pending.values())
+            listener.cancel()
+            self.writer.close()
+
+    async def sleep_until(self, start, offset, speed):
+        """Wait for a recorded offset at the replay speed; returns how late the replay already was."""
+        due = start + (offset / speed if speed else 0.0)
+        delay = due - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+            return 0.0
+        return -delay
+
+    def send(self, name, command):
+        if name == "!quit":
+            # The server closes the connection instead of replying.
+            self.writer.write(encode_command(command))
+            return
+        self.next_tag += 1
+        reply = asyncio.get_running_loop().create_future()
+        self.pending[self.next_tag] = (reply, name, time.perf_counter())
+        self.writer.write(encode_command(command, self.next_tag))
+
+    async def listen(self):
+        replies = ReplyReader()
+        try:
+            while True:
+                data = await self.reader.read(RECV_SIZE)
+                if not data:
+                    break
+                now = time.perf_counter()
+                for tag, _ in replies.feed(data):
+                    # Streamed replies arrive in several blocks; the first one is timed.
+                    if tag in self.pending and not self.pending[tag][0].done():
+                        reply, name, sent = self.pending[tag]
+                        reply.set_result(None)
+                        self.stats.record(name, now - sent)
+        except (ConnectionError, OSError):
+            pass
+
+
+async def replay(host, port, sessions, speed):
+    stats = Stats()
+    clients = [ReplayClient(stats) for _ in sessions]
+    start = time.monotonic()
+    started = time.perf_counter()
+    await asyncio.gather(*(client.run(host, port, session, start, speed)
+                           for client, session in zip(clients, sessions.values())))
+    elapsed = time.perf_counter() - started
+    commands = sum(len(samples) for samples in stats.latencies.values())
+    return {
+        "connections": len(sessions),
+        "speed": speed,
+        "duration_s": elapsed,
+        "commands": commands,
+        "commands_per_s": commands / elapsed if elapsed else None,
+        "errors": stats.errors,
+        "skipped": sum(client.skipped for client in clients),
+        "send_lag": summarize([lag for client in clients for lag in client.lag]),
+        "latency": {command: summarize(samples) for command, samples in sorted(stats.latencies.items())},
+        "all_commands": summarize([s for samples in stats.latencies.values() for s in samples]),
+    }
+
+
+def print_report(result):
+    speed = f"{result['speed']:g}x speed" if result["speed"] else "full speed"
+    print(f"Replayed {result['connections']} connections at {speed} in {result['duration_s']:.1f}s")
+    print(f"  commands/s     {result['commands_per_s']:.0f} ({result['commands']} answered, "
+          f"{result['errors']} errors, {result['skipped']} skipped)")
+    lag = result["send_lag"]
+    if lag["count"]:
+        # Sends that fell behind schedule mean the replay itself could not keep up.
+        print(f"  send lag       p50 {lag['p50_ms']:.2f} ms, p99 {lag['p99_ms']:.2f} ms")
+    rows = [("all", result["all_commands"])] + sorted(result["latency"].items())
+    print(f"  {'':14} {'count':>8} {'p50 ms':>9} {'p99 ms':>9} {'p999 ms':>9}")
+    for name, summary in rows:
+        if summary["count"]:
+            print(f"  {name:14} {summary['count']:>8} {summary['p50_ms']:>9.2f} "
+                  f"{summary['p99_ms']:>9.2f} {summary['p999_ms']:>9.2f}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a traffic capture against the bulletin board server.",
+                                     epilog="Arguments after '--' are passed to backend.py.")
+    parser.add_argument("capture", help="File written by backend.py --capture.")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Replay this many times faster than recorded; 0 sends everything as fast as possible.")
+    parser.add_argument("--connect", metavar="HOST:PORT", help="Replay against a running server instead of launching one.")
+    parser.add_argument("--json", metavar="PATH", help="Write machine-readable results here ('-' for stdout).")
+    # Split off the server's arguments first; a trailing REMAINDER would also swallow options
+    # given after the capture path.
+    argv = sys.argv[1:] if argv is None else argv
+    server_args = argv[argv.index("--") + 1:] if "--" in argv else []
+    args = parser.parse_args(argv[:len(argv) - len(server_args) - ("--" in argv)])
+    args.server_args = server_args
+    return args
+
+
+def main():
+    args = parse_args()
+    sessions = load_sessions(args.capture)
+    raise_fd_limit()
+    server = None
+    if args.connect:
+        host, _, port = args.connect.rpartition(":")
+        port = int(port)
+    else:
+        host, port = "127.0.0.1", free_port()
+        server = launch_server(port, args.server_args)
+    try:
+        result = asyncio.run(replay(host, port, sessions, args.speed))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+    result["capture"] = args.capture
+    result["server_args"] = args.server_args
+    if args.json == "-":
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(result)
+        if args.json:
+            with open(args.json, "w") as output:
+                json.dump(result, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import heapq
+import math
+import re
+from collections import Counter, deque
+
+# Most message ids returned by one search
+SEARCH_LIMIT = 20
+# Newest messages of a durable log that its index covers, which keeps the index's memory
+# bounded however long the log grows; older messages can still be read but not searched
+MAX_INDEXED = 65536
+# Messages indexed per lock acquisition when catching up on a log that already held messages
+BACKFILL_BATCH = 256
+
+WORD = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return [word.lower() for word in WORD.findall(text)]
+
+
+class SearchIndex:
+    """Inverted index over one message log, updated as messages are appended.
+
+    Each term maps to the ids of the messages containing it along with how often it occurs.
+    Messages the log has evicted, and with a limit all but the newest `limit`, are dropped
+    from the index, so it never outgrows the log. Messages a log held before its index was
+    created are indexed with backfill(), newest first. Not thread-safe; callers hold the lock
+    of the board or room that owns it.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.postings = {}  # term -> {msg_id: occurrences}
+        self.documents = deque()  # (msg_id, terms) in id order, for expiring old messages
+
+    def floor(self, log):
+        """The oldest id of log this index covers."""
+        return max(log.first_id, log.next_id - self.limit) if self.limit else log.first_id
+
+    def update(self, log, msg):
+        """Index a message just appended to log and forget the ones that fell out of range."""
+        self.add(msg.msg_id, msg.text)
+        self.expire(self.floor(log))
+
+    def backfill(self, log, before, batch=BACKFILL_BATCH):
+        """Index up to batch messages of log just below id before, which nothing indexed so far is.
+
+        Returns the id to continue below, or None once every message the index covers is in.
+        """
+        low = max(self.floor(log), before - batch)
+        for msg_id in range(before - 1, low - 1, -1):
+            msg = log.get(msg_id)
+            if msg:
+                self.add(msg_id, msg.text, older=True)
+        return low if low > self.floor(log) else None
+
+    def add(self, msg_id, text, older=False):
+        """Index a message; older ones, from backfill(), precede every message indexed so far."""
+        counts = Counter(tokenize(text))
+        for term, occurrences in counts.items():
+            self.postings.setdefault(term, {})[msg_id] = occurrences
+        if older:
+            self.documents.appendleft((msg_id, tuple(counts)))
+        else:
+            self.documents.append((msg_id, tuple(counts)))
+
+    def expire(self, first_id):
+        """Forget messages with ids below first_id."""
+        while self.documents and self.documents[0][0] < first_id:
+            msg_id, terms = self.documents.popleft()
+            for term in terms:
+                matches = self.postings[term]
+                del matches[msg_id]
+                if not matches:
+                    del self.postings[term]
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """Return the ids of the best-matching messages, best first.
+
+        Messages are ranked by tf-idf, so rare terms and messages matching several terms
+        score higher; ties go to the newer message.
+        """
+        total = len(self.documents)
+        scores = {}
+        for term in set(tokenize(query)):
+            matches = self.postings.get(term)
+            if not matches:
+                continue
+            weight = math.log(1 + total / len(matches))
+            for msg_id, occurrences in matches.items():
+                scores[msg_id] = scores.get(msg_id, 0.0) + (1 + math.log(occurrences)) * weight
+        return heapq.nlargest(limit, scores, key=lambda msg_id: (scores[msg_id], msg_id))
@@ -0,0 +1,208 @@
+import bisect
+import mmap
+import os
+import struct
+
+# Segment defaults for the durable log
+SEGMENT_BYTES = 16 * 1024 * 1024
+SEGMENT_RECORDS = 65536
+MAX_SEGMENTS = 8
+
+# Record header in a .log segment: timestamp, user length, text length
+RECORD_HEADER = struct.Struct("<dHI")
+# Entry in a .idx segment: record position and length in the matching .log file
+INDEX_ENTRY = struct.Struct("<II")
+
+
+class Message:
+    """A posted message. Timestamps stay numeric and are only formatted when shown."""
+
+    __slots__ = ("msg_id", "user", "time", "text")
+
+    def __init__(self, user, time, text, msg_id=None):
+        self.msg_id = msg_id
+        self.user = user
+        self.time = time
+        self.text = text
+
+
+class RingLog:
+    """Fixed-capacity ring buffer of messages; once full, each append overwrites the oldest.
+
+    Ids are assigned sequentially from 1 and never reused, so an id keeps referring to the
+    same message until it is evicted. Not thread-safe; callers hold the owning lock.
+    """
+
+    def __init__(self, capacity, next_id=1):
+        self.capacity = capacity
+        self.slots = [None] * capacity
+        self.next_id = next_id
+
+    @property
+    def first_id(self):
+        return max(1, self.next_id - self.capacity)
+
+    def append(self, msg):
+        """Store a message, evicting the oldest if full, and return its id."""
+        msg.msg_id = self.next_id
+        self.slots[(self.next_id - 1) % self.capacity] = msg
+        self.next_id += 1
+        return msg.msg_id
+
+    def get(self, msg_id):
+        if self.first_id <= msg_id < self.next_id:
+            return self.slots[(msg_id - 1) % self.capacity]
+        return None
+
+    def __len__(self):
+        return self.next_id - self.first_id
+
+
+class Segment:
+    """One .log data file plus its fixed-size, memory-mapped .idx offset index."""
+
+    def __init__(self, directory, base_id, capacity):
+        self.base_id = base_id
+        self.capacity = capacity
+        stem = os.path.join(directory, f"{base_id:020d}")
+        self.log_path = stem + ".log"
+        self.index_path = stem + ".idx"
+
+        self.log_file = open(self.log_path, "a+b")
+        index_size = capacity * INDEX_ENTRY.size
+        with open(self.index_path, "a+b") as index_file:
+            if os.path.getsize(self.index_path) < index_size:
+                index_file.truncate(index_size)
+        self.index_file = open(self.index_path, "r+b")
+        self.index = mmap.mmap(self.index_file.fileno(), index_size)
+        self.count = self._count_entries()
+        self.size = self._end_of(self.count - 1) if self.count else 0
+
+    def _entry(self, slot):
+        return INDEX_ENTRY.unpack_from(self.index, slot * INDEX_ENTRY.size)
+
+    def _end_of(self, slot):
+        position, length = self._entry(slot)
+        return position + length
+
+    def _count_entries(self):
+        """Entries are written in order, so the first empty slot can be found by binary search."""
+        low, high = 0, self.capacity
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry(middle)[1]:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def recover(self):
+        """Index complete records written after the last index entry and drop a torn trailing write."""
+        self.log_file.seek(self.size)
+        data = self.log_file.read()
+        offset = 0
+        while self.count < self.capacity and offset + RECORD_HEADER.size <= len(data):
+            _, user_length, text_length = RECORD_HEADER.unpack_from(data, offset)
+            length = RECORD_HEADER.size + user_length + text_length
+            if offset + length > len(data):
+                break
+            INDEX_ENTRY.pack_into(self.index, self.count * INDEX_ENTRY.size, self.size, length)
+            self.count += 1
+            self.size += length
+            offset += length
+        self.log_file.truncate(self.size)
+
+    def append(self, record):
+        self.log_file.seek(0, os.SEEK_END)
+        self.log_file.write(record)
+        self.log_file.flush()
+        INDEX_ENTRY.pack_into(self.index, self.count * INDEX_ENTRY.size, self.size, len(record))
+        self.count += 1
+        self.size += len(record)
+
+    def read(self, slot):
+        position, length = self._entry(slot)
+        self.log_file.seek(position)
+        return self.log_file.read(length)
+
+    def close(self):
+        self.index.flush()
+        self.index.close()
+        self.index_file.close()
+        self.log_file.close()
+
+    def delete(self):
+        self.close()
+        os.remove(self.log_path)
+        os.remove(self.index_path)
+
+
+class MessageLog:
+    """Durable append-only message log split into segment files with memory-mapped offset indexes.
+
+    Message ids are stable 1-based offsets into the log, so a lookup is one index read and one
+    file read no matter how many messages have been written. Full segments roll over to a new
+    file and the oldest segments are deleted once more than max_segments exist. Not
+    thread-safe; callers hold the lock of the board or room that owns the log.
+    """
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, segment_records=SEGMENT_RECORDS, max_segments=MAX_SEGMENTS):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_records = segment_records
+        self.max_segments = max_segments
+        os.makedirs(directory, exist_ok=True)
+
+        bases = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith(".log"))
+        self.segments = [Segment(directory, base, segment_records) for base in bases]
+        if self.segments:
+            self.segments[-1].recover()
+        else:
+            self.segments.append(Segment(directory, 1, segment_records))
+        self.bases = [segment.base_id for segment in self.segments]
+
+    @property
+    def first_id(self):
+        return self.segments[0].base_id
+
+    @property
+    def next_id(self):
+        active = self.segments[-1]
+        return active.base_id + active.count
+
+    def append(self, msg):
+        """Write a message and return its id."""
+        user, text = msg.user.encode(), msg.text.encode()
+        record = RECORD_HEADER.pack(msg.time, len(user), len(text)) + user + text
+        active = self.segments[-1]
+        if active.count >= active.capacity or (active.count and active.size + len(record) > self.segment_bytes):
+            active = self._roll()
+        msg.msg_id = active.base_id + active.count
+        active.append(record)
+        return msg.msg_id
+
+    def get(self, msg_id):
+        """Return the message with the given id, or None if it was never written or has expired."""
+        if not self.first_id <= msg_id < self.next_id:
+            return None
+        segment = self.segments[bisect.bisect_right(self.bases, msg_id) - 1]
+        record = segment.read(msg_id - segment.base_id)
+        timestamp, user_length, _ = RECORD_HEADER.unpack_from(record)
+        user_end = RECORD_HEADER.size + user_length
+        return Message(record[RECORD_HEADER.size:user_end].decode(), timestamp, record[user_end:].decode(), msg_id)
+
+    def __len__(self):
+        return self.next_id - self.first_id
+
+    def _roll(self):
+        segment = Segment(self.directory, self.next_id, self.segment_records)
+        self.segments.append(segment)
+        self.bases.append(segment.base_id)
+        while len(self.segments) > self.max_segments:
+            self.segments.pop(0).delete()
+            self.bases.pop(0)
+        return segment
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
@@ -0,0 +1,220 @@
+import socket
+import threading
+import time
+
+import pytest
+
+import backend
+from bus import Broker, BusClient
+from presence import RosterCache, Subscriptions
+from protocol import Interner, ReplyReader, encode_command
+from search import SearchIndex
+from storage import Message, MessageLog, RingLog
+
+
+class Client:
+    """A connection served by the threaded handler over a socketpair.
+
+    Commands are sent tagged; calling the client returns the reply to one command, and
+    untagged text such as broadcasts is collected in `pushed`.
+    """
+
+    def __init__(self):
+        self.sock, server = socket.socketpair()
+        self.sock.settimeout(5)
+        self.handler = threading.Thread(target=backend.client_handler, args=(server, "test"), daemon=True)
+        self.handler.start()
+        self.reader = ReplyReader()
+        self.tag = 0
+        self.answers = {}
+        self.pushed = ""
+
+    def __call__(self, command, until=""):
+        """Send a command and return its reply; a streamed reply is read until it contains `until`."""
+        self.tag += 1
+        self.sock.sendall(encode_command(command, self.tag))
+        while self.tag not in self.answers or until not in self.answers[self.tag]:
+            self.read()
+        return self.answers.pop(self.tag)
+
+    def pipeline(self, *commands):
+        """Send several commands in one write and return their replies in order."""
+        tags = range(self.tag + 1, self.tag + 1 + len(commands))
+        self.tag += len(commands)
+        self.sock.sendall(b"".join(encode_command(command, tag) for command, tag in zip(commands, tags)))
+        while not all(tag in self.answers for tag in tags):
+            self.read()
+        return [self.answers.pop(tag) for tag in tags]
+
+    def expect(self, text):
+        """Read until some untagged text contains `text`."""
+        while text not in self.pushed:
+            self.read()
+
+    def read(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise ConnectionError("server closed the connection")
+        for tag, text in self.reader.feed(data):
+            if tag is None:
+                self.pushed += text
+            else:
+                self.answers[tag] = self.answers.get(tag, "") + text
+
+
+@pytest.fixture(autouse=True)
+def server_state(monkeypatch):
+    """Give every test an empty in-memory server without rate limits."""
+    for name, value in {
+        "connected_users": {}, "message_board": RingLog(backend.BOARD_CAPACITY), "board_index": SearchIndex(),
+        "room_index": sorted(backend.DEFAULT_ROOMS), "chat_rooms": {}, "evicted_next_ids": {}, "rooms_dir": None,
+        "rosters": RosterCache(), "presence": Subscriptions(), "user_ids": Interner(), "room_ids": Interner(),
+        "open_connections": 0, "board_bucket": None, "USER_RATE": 0.0, "ROOM_RATE": 0.0,
+    }.items():
+        monkeypatch.setattr(backend, name, value)
+
+
+@pytest.fixture
+def connect():
+    clients = []
+
+    def connect(user=None):
+        client = Client()
+        clients.append(client)
+        if user:
+            assert client(f"!register {user}") == f"Welcome to the server, {user}!\n"
+        return client
+
+    yield connect
+    # Let each handler finish disconnecting before the next test replaces the server state.
+    for client in clients:
+        client.sock.close()
+        client.handler.join(5)
+
+
+def test_rooms_require_registration(connect):
+    guest = connect()
+    assert guest("!joinroom Room1").startswith("Register first")
+    assert guest("!roommsg Room1 hi").startswith("Register first")
+    amy = connect("amy")
+    assert amy("!joinroom Room1") == "You joined Room1.\n"
+    assert amy("!roomusers Room1") == "Participants in Room1:\namy\n"
+
+
+def test_worker_replies_after_storing_its_own_post(connect, monkeypatch, tmp_path):
+    # With --workers a post is stored when the bus relays it back; the reply must wait for that.
+    path = str(tmp_path / "bus.sock")
+    threading.Thread(target=Broker(path).serve_forever, daemon=True).start()
+    monkeypatch.setattr(backend, "bus", BusClient(path, 1, backend.apply_event))
+    amy = connect("amy")
+    assert amy("!joinroom Room3") == "You joined Room3.\n"
+    sent, retrieved, room_sent, room_retrieved = amy.pipeline(
+        "!send first post", "!retrieve 1", "!roommsg Room3 hey", "!roomretrieve Room3 1")
+    assert sent == "Message sent successfully.\n"
+    assert retrieved.endswith("amy said: first post\n")
+    assert room_sent == "Message sent to Room3.\n"
+    assert room_retrieved.endswith("amy said: hey\n")
+
+
+def test_search_sees_new_posts_and_backfills_stored_ones(connect, tmp_path):
+    log = MessageLog(str(tmp_path / "public"))
+    for i in range(1000):
+        log.append(Message("old", 0.0, f"archived note {i}"))
+    log.close()
+    backend.configure_storage(str(tmp_path))
+    amy = connect("amy")
+    assert amy.pipeline("!send fresh note", "!search public fresh")[1].startswith("Matching message IDs, best first: 1001\n")
+    # The oldest message is backfilled last.
+    deadline = time.monotonic() + 5
+    while not amy("!search public archived 0").startswith("Matching message IDs, best first: 1 "):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_history_streams_in_batches_and_says_where_to_resume(connect, monkeypatch):
+    monkeypatch.setattr(backend, "message_board", RingLog(100))
+    monkeypatch.setattr(backend, "HISTORY_BATCH", 3)
+    amy = connect("amy")
+    for i in range(10):
+        amy(f"!send post {i}")
+    lines = amy("!history public 3 5", until="End of history").splitlines()
+    assert lines[0] == "History of public after message 3:"
+    assert [line.split(" said: ")[1] for line in lines[1:-1]] == ["post 3", "post 4", "post 5", "post 6", "post 7"]
+    assert lines[-1] == "End of history: 5 messages. Continue with '!history public 8'."
+
+
+def test_history_starts_at_the_oldest_message_still_stored(connect):
+    amy = connect("amy")
+    for i in range(8):
+        amy(f"!send post {i}")
+    lines = amy("!history public", until="End of history").splitlines()
+    assert [line.split(" said: ")[1] for line in lines[1:-1]] == ["post 3", "post 4", "post 5", "post 6", "post 7"]
+    assert lines[-1] == "End of history: 5 messages. Continue with '!history public 8'."
+    assert amy("!history Room1", until="") == "Room does not exist or you are not a participant.\n"
+
+
+def test_rooms_lists_one_page_at_a_time(connect, monkeypatch):
+    monkeypatch.setattr(backend, "ROOMS_PAGE_SIZE", 2)
+    amy = connect("amy")
+    assert amy("!createroom Alpha").startswith("Created Alpha.")
+    assert amy("!createroom Alpha") == "Room already exists.\n"
+    amy("!createroom Alps")
+    footer = "Use '!rooms [prefix] [page]' for more.\n"
+    assert amy("!rooms") == f"Available Rooms:\nAlpha\nAlps\nPage 1 of 4. {footer}"
+    assert amy("!rooms 4") == f"Available Rooms:\nRoom5\nPage 4 of 4. {footer}"
+    assert amy("!rooms Al") == "Available Rooms:\nAlpha\nAlps\n"
+    assert amy("!rooms Room 2") == f"Available Rooms:\nRoom3\nRoom4\nPage 2 of 3. {footer}"
+    assert amy("!rooms Room 4") == "No rooms found.\n"
+    assert amy("!rooms 0") == "Usage: !rooms [prefix] [page]\n"
+
+
+@pytest.mark.parametrize("durable", [False, True])
+def test_evicted_room_keeps_its_ids(connect, tmp_path, durable):
+    if durable:
+        backend.configure_storage(str(tmp_path))
+    amy = connect("amy")
+    amy("!joinroom Room1")
+    amy("!roommsg Room1 one")
+    amy("!roommsg Room1 two")
+    amy("!leaveroom Room1")
+    backend.evict_idle_rooms(0)
+    assert "Room1" not in backend.chat_rooms
+    amy("!joinroom Room1")
+    amy("!roommsg Room1 three")
+    assert amy("!roomretrieve Room1 3").endswith("amy said: three\n")
+    first = amy("!roomretrieve Room1 1")
+    # Only a durable room still has its history after eviction, but ids are never reused either way.
+    assert first.endswith("amy said: one\n") if durable else first == "Message ID not found in the room.\n"
+
+
+def test_presence_sends_the_roster_then_only_changes(connect):
+    amy = connect("amy")
+    assert amy("!presence public") == "Presence updates for public started. Members now:\namy\n"
+    assert amy("!presence Room2") == "Room does not exist or you are not a participant.\n"
+    amy("!joinroom Room2")
+    assert amy("!presence Room2 on") == "Presence updates for Room2 started. Members now:\namy\n"
+    bob = connect("bob")
+    amy.expect("Presence public: +bob\n")
+    bob("!joinroom Room2")
+    amy.expect("Presence Room2: +bob\n")
+    assert amy("!roomusers Room2") == "Participants in Room2:\namy\nbob\n"
+    bob.sock.close()
+    bob.handler.join(5)
+    amy.expect("Presence Room2: -bob\n")
+    amy.expect("Presence public: -bob\n")
+    assert amy("!active") == "Active users:\namy\n"
+    assert amy("!presence public off") == "Presence updates for public stopped.\n"
+
+
+def test_room_limit_refusal_keeps_the_senders_tokens(connect, monkeypatch):
+    monkeypatch.setattr(backend, "USER_RATE", 0.001)
+    monkeypatch.setattr(backend, "USER_BURST", 2)
+    monkeypatch.setattr(backend, "ROOM_RATE", 0.001)
+    monkeypatch.setattr(backend, "ROOM_BURST", 1)
+    amy = connect("amy")
+    amy("!joinroom Room1")
+    assert amy("!roommsg Room1 one") == "Message sent to Room1.\n"
+    assert amy("!roommsg Room1 two").startswith("Rate limit exceeded: at most 0.001 messages per second per room")
+    # The refused room message did not use up the second token of the user burst.
+    assert amy("!send one") == "Message sent successfully.\n"
+    assert amy("!send two").startswith("Rate limit exceeded: at most 0.001 messages per second per user")
@@ -0,0 +1,36 @@
+import threading
+
+from bus import Broker, BusClient
+
+
+def start_broker(tmp_path):
+    path = str(tmp_path / "bus.sock")
+    threading.Thread(target=Broker(path).serve_forever, daemon=True).start()
+    return path
+
+
+def test_failing_event_does_not_stop_the_listener(tmp_path, capsys):
+    # The clients are left connected: a worker whose bus closes exits the process.
+    applied = []
+    done = threading.Event()
+
+    def dispatch(event):
+        if event["op"] == "bad":
+            raise AttributeError("boom")
+        applied.append(event["op"])
+        done.set()
+
+    client = BusClient(start_broker(tmp_path), 1, dispatch)
+    client.publish({"op": "bad"})
+    client.publish({"op": "good"})
+    assert done.wait(5)
+    assert applied == ["good"]
+    assert "failed to apply a bad event" in capsys.readouterr().out
+
+
+def test_claims_are_exclusive(tmp_path):
+    path = start_broker(tmp_path)
+    first, second = BusClient(path, 1, lambda event: None), BusClient(path, 2, lambda event: None)
+    assert first.claim("amy")
+    assert not second.claim("amy")
+    assert second.claim("bob")
@@ -0,0 +1,44 @@
+from cache import MessageCache, is_message, retrieval_key
+
+MESSAGE = "[2026-01-01 12:00:00] amy said: hi\n"
+
+
+def test_retrieval_key():
+    assert retrieval_key(["!retrieve", "4"]) == (None, 4)
+    assert retrieval_key(["!roomretrieve", "Room1", "4"]) == ("Room1", 4)
+    assert retrieval_key(["!retrieve", "four"]) is None
+    assert retrieval_key(["!send", "4"]) is None
+
+
+def test_is_message():
+    assert is_message(MESSAGE)
+    assert not is_message("Message ID not found.\n")
+
+
+def test_cache_evicts_least_recently_used():
+    cache = MessageCache(capacity=2)
+    cache.put((None, 1), "one")
+    cache.put((None, 2), "two")
+    assert cache.get((None, 1)) == "one"
+    cache.put((None, 3), "three")
+    assert cache.get((None, 2)) is None
+    assert cache.get((None, 1)) == "one"
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_cache_only_keeps_tracked_messages():
+    cache = MessageCache()
+    cache.track(1, ("Room1", 1))
+    cache.track(2, ("Room1", 2))
+    cache.resolve(1, MESSAGE)
+    cache.resolve(2, "Message ID not found.\n")
+    cache.resolve(3, MESSAGE)
+    assert cache.messages == {("Room1", 1): MESSAGE}
+    assert cache.pending == {}
+
+
+def test_zero_capacity_disables_cache():
+    cache = MessageCache(capacity=0)
+    cache.put((None, 1), MESSAGE)
+    assert cache.get((None, 1)) is None
+
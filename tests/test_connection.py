@@ -0,0 +1,67 @@
+import socket
+import threading
+import time
+
+from connection import OVERLOAD_NOTICE, ClientConnection
+
+
+class StalledSocket:
+    """A socket whose peer stopped reading: the first write blocks until the socket is shut down."""
+
+    def __init__(self):
+        self.writing = threading.Event()
+        self.released = threading.Event()
+        self.sent = b""
+
+    def sendall(self, data):
+        self.writing.set()
+        self.released.wait(5)
+        self.sent += data
+
+    def shutdown(self, how):
+        self.released.set()
+
+    def close(self):
+        pass
+
+
+def stalled_connection(high_water):
+    sock = StalledSocket()
+    conn = ClientConnection(sock, max_pending=64, high_water=high_water)
+    conn.send(b"welcome\n")
+    assert sock.writing.wait(5)
+    return sock, conn
+
+
+def test_replies_do_not_count_toward_high_water():
+    sock, conn = stalled_connection(high_water=4)
+    for _ in range(20):
+        assert conn.send(b"reply\n", block=True)
+    assert [conn.send(b"broadcast\n") for _ in range(4)] == [True] * 4
+    assert conn.broadcasts == 4
+    assert not conn.closed
+
+
+def test_broadcasts_past_high_water_disconnect():
+    sock, conn = stalled_connection(high_water=3)
+    assert [conn.send(b"broadcast\n") for _ in range(4)] == [True, True, True, False]
+    assert conn.closed
+    sock.released.set()
+    deadline = time.monotonic() + 5
+    while OVERLOAD_NOTICE.encode() not in sock.sent and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sock.sent.endswith(OVERLOAD_NOTICE.encode())
+
+
+def test_sent_broadcasts_leave_the_count():
+    ours, theirs = socket.socketpair()
+    conn = ClientConnection(theirs, high_water=100)
+    for i in range(50):
+        conn.send(b"broadcast\n")
+    ours.settimeout(5)
+    received = b""
+    while received.count(b"\n") < 50:
+        received += ours.recv(65536)
+    assert conn.broadcasts == 0
+    conn.close()
+    ours.close()
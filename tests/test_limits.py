@@ -0,0 +1,20 @@
+from limits import TokenBucket, make_bucket
+
+
+def test_bucket_allows_burst_then_refuses():
+    bucket = TokenBucket(rate=1, burst=3)
+    assert [bucket.take() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take() > 0
+
+
+def test_refund_returns_token_up_to_burst():
+    bucket = TokenBucket(rate=0.001, burst=2)
+    bucket.take()
+    bucket.refund()
+    bucket.refund()
+    assert bucket.tokens == 2
+
+
+def test_zero_rate_disables_limit():
+    assert make_bucket(0, 10) is None
+    assert make_bucket(2, 10).burst == 10
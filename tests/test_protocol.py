@@ -0,0 +1,69 @@
+import pytest
+
+from protocol import (OP_SERVER_TEXT, BinaryFrameBuffer, Compressor, Decompressor, FrameBuffer, FrameTooLarge,
+                      ReplyReader, encode_command, encode_frame, encode_reply, split_tag)
+
+
+# Text framing
+
+def test_frame_buffer_joins_partial_reads():
+    frames = FrameBuffer()
+    assert frames.feed(b"!send hel") == []
+    assert frames.feed(b"lo\r\n\n!active\n!qu") == ["!send hello", "!active"]
+    assert frames.feed(b"it\n") == ["!quit"]
+
+
+def test_frame_buffer_rejects_long_partial_frame():
+    frames = FrameBuffer(max_frame_size=16)
+    with pytest.raises(FrameTooLarge):
+        frames.feed(b"x" * 17)
+
+
+def test_frame_buffer_rejects_long_complete_line():
+    frames = FrameBuffer(max_frame_size=16)
+    with pytest.raises(FrameTooLarge):
+        frames.feed(b"!active\n" + b"x" * 17 + b"\n")
+
+
+def test_tags_round_trip():
+    frame = encode_command("!send  hi   there", 7)
+    assert frame == b"#7 !send hi there\n"
+    assert split_tag(FrameBuffer().feed(frame)[0]) == (7, "!send hi there")
+    assert split_tag("#x !send") == (None, "#x !send")
+
+
+def test_reply_reader_separates_tagged_replies():
+    data = b"broadcast\n" + encode_reply(3, "two\nlines\n".encode()) + "untagged é\n".encode()
+    replies = ReplyReader()
+    # Byte by byte, so headers, bodies and multi-byte characters are all split across reads.
+    events = [event for i in range(len(data)) for event in replies.feed(data[i:i + 1])]
+    assert [(tag, text) for tag, text in events if tag is not None] == [(3, "two\nlines\n")]
+    assert "".join(text for tag, text in events if tag is None) == "broadcast\nuntagged é\n"
+
+
+# Binary framing
+
+def test_binary_frame_buffer_splits_frames():
+    data = encode_frame(1, 5, b"abc") + encode_frame(2, 6)
+    frames = BinaryFrameBuffer()
+    assert frames.feed(data[:4]) == []
+    assert frames.feed(data[4:]) == [(5, 1, b"abc"), (6, 2, b"")]
+
+
+def test_binary_frame_buffer_rejects_large_payload():
+    with pytest.raises(FrameTooLarge):
+        BinaryFrameBuffer(max_payload=8).feed(encode_frame(OP_SERVER_TEXT, 1, b"x" * 9))
+
+
+# Compression
+
+def test_compression_round_trip():
+    compressor, decompressor = Compressor(threshold=64), Decompressor()
+    batches = [[b"short\n"], [b"a much longer line that is worth compressing\n"] * 20, [b"x" * 200000]]
+    received = b""
+    for batch in batches:
+        data = b"".join(compressor.pack(batch))
+        # Fed in uneven pieces, so blocks arrive split across reads.
+        for start in range(0, len(data), 1000):
+            received += decompressor.feed(data[start:start + 1000])
+    assert received == b"".join(b"".join(batch) for batch in batches)
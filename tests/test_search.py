@@ -0,0 +1,67 @@
+from search import SearchIndex, tokenize
+from storage import Message, RingLog
+
+
+def test_tokenize():
+    assert tokenize("Hello, WORLD! it's 2 o'clock") == ["hello", "world", "it", "s", "2", "o", "clock"]
+
+
+def test_rare_terms_rank_higher():
+    index = SearchIndex()
+    index.add(1, "lunch today")
+    index.add(2, "lunch tomorrow")
+    index.add(3, "lunch and the deploy today")
+    assert index.search("deploy lunch")[0] == 3
+    assert set(index.search("lunch")) == {1, 2, 3}
+    assert index.search("nothing") == []
+
+
+def test_ties_go_to_newer_messages():
+    index = SearchIndex()
+    for msg_id in range(1, 6):
+        index.add(msg_id, "same words")
+    assert index.search("same", limit=2) == [5, 4]
+
+
+def test_expire_drops_old_messages():
+    index = SearchIndex()
+    index.add(1, "alpha beta")
+    index.add(2, "beta")
+    index.expire(2)
+    assert index.search("alpha beta") == [2]
+    assert "alpha" not in index.postings
+
+
+def test_update_follows_the_log():
+    log, index = RingLog(2), SearchIndex()
+    for text in ("first post", "second post", "third post"):
+        msg = Message("u", 0.0, text)
+        log.append(msg)
+        index.update(log, msg)
+    assert sorted(index.search("post")) == [2, 3]
+
+
+def test_limit_keeps_the_newest_messages():
+    log, index = RingLog(100), SearchIndex(limit=3)
+    for i in range(5):
+        msg = Message("u", 0.0, f"post {i}")
+        log.append(msg)
+        index.update(log, msg)
+    assert sorted(index.search("post")) == [3, 4, 5]
+
+
+def test_backfill_indexes_older_messages_newest_first():
+    log = RingLog(100)
+    for i in range(10):
+        log.append(Message("u", 0.0, f"old {i}"))
+    index = SearchIndex(limit=8)
+    before = log.next_id
+    msg = Message("u", 0.0, "new post")
+    log.append(msg)
+    index.update(log, msg)
+    before = index.backfill(log, before, batch=4)
+    assert sorted(index.search("old")) == [7, 8, 9, 10]
+    assert index.backfill(log, before, batch=4) is None
+    # The limit leaves room for 7 of the 10 older messages.
+    assert sorted(index.search("old")) == [4, 5, 6, 7, 8, 9, 10]
+    assert [msg_id for msg_id, _ in index.documents] == list(range(4, 12))
@@ -0,0 +1,115 @@
+import os
+
+from storage import INDEX_ENTRY, Message, MessageLog, RingLog
+
+
+def post(log, count, start=0):
+    return [log.append(Message(f"user{i}", 1000.0 + i, f"message {i}")) for i in range(start, start + count)]
+
+
+# RingLog
+
+def test_ring_log_evicts_oldest():
+    log = RingLog(3)
+    assert post(log, 5) == [1, 2, 3, 4, 5]
+    assert log.first_id == 3
+    assert len(log) == 3
+    assert log.get(2) is None
+    assert log.get(3).text == "message 2"
+    assert log.get(6) is None
+
+
+# MessageLog
+
+def test_append_and_get(tmp_path):
+    log = MessageLog(str(tmp_path))
+    assert post(log, 3) == [1, 2, 3]
+    msg = log.get(2)
+    assert (msg.msg_id, msg.user, msg.time, msg.text) == (2, "user1", 1001.0, "message 1")
+    assert log.get(0) is None
+    assert log.get(4) is None
+    log.close()
+
+
+def test_non_ascii_round_trip(tmp_path):
+    log = MessageLog(str(tmp_path))
+    msg_id = log.append(Message("zoë", 1.5, "héllo ✓"))
+    assert (log.get(msg_id).user, log.get(msg_id).text) == ("zoë", "héllo ✓")
+    log.close()
+
+
+def test_rollover_by_record_count(tmp_path):
+    log = MessageLog(str(tmp_path), segment_records=4)
+    post(log, 10)
+    assert [segment.base_id for segment in log.segments] == [1, 5, 9]
+    assert len(log) == 10
+    assert [log.get(msg_id).text for msg_id in (1, 4, 5, 10)] == ["message 0", "message 3", "message 4", "message 9"]
+    log.close()
+
+
+def test_rollover_by_size(tmp_path):
+    log = MessageLog(str(tmp_path), segment_bytes=100)
+    for i in range(4):
+        log.append(Message("u", 0.0, "x" * 60))
+    # Each record is over half a segment, so every one starts a new segment.
+    assert [segment.base_id for segment in log.segments] == [1, 2, 3, 4]
+    log.close()
+
+
+def test_retention_keeps_ids(tmp_path):
+    log = MessageLog(str(tmp_path), segment_records=4, max_segments=2)
+    post(log, 13)
+    assert log.first_id == 9
+    assert log.next_id == 14
+    assert len(log) == 5
+    assert log.get(8) is None
+    assert log.get(9).text == "message 8"
+    assert log.get(13).text == "message 12"
+    assert sorted(name for name in os.listdir(tmp_path) if name.endswith(".log")) == [
+        f"{9:020d}.log", f"{13:020d}.log"]
+    log.close()
+
+
+def test_reopen_continues_ids(tmp_path):
+    log = MessageLog(str(tmp_path), segment_records=4, max_segments=2)
+    post(log, 6)
+    log.close()
+
+    log = MessageLog(str(tmp_path), segment_records=4, max_segments=2)
+    assert (log.first_id, log.next_id) == (1, 7)
+    assert log.get(6).text == "message 5"
+    assert post(log, 3, start=6) == [7, 8, 9]
+    assert log.first_id == 5
+    log.close()
+
+
+def test_recover_unindexed_records(tmp_path):
+    log = MessageLog(str(tmp_path))
+    post(log, 3)
+    # Simulate a crash after the record write but before its index entry reached disk.
+    segment = log.segments[-1]
+    INDEX_ENTRY.pack_into(segment.index, 2 * INDEX_ENTRY.size, 0, 0)
+    log.close()
+
+    log = MessageLog(str(tmp_path))
+    assert log.next_id == 4
+    assert log.get(3).text == "message 2"
+    log.close()
+
+
+def test_recover_drops_torn_write(tmp_path):
+    log = MessageLog(str(tmp_path))
+    post(log, 2)
+    size = log.segments[-1].size
+    log.close()
+
+    path = os.path.join(tmp_path, f"{1:020d}.log")
+    with open(path, "ab") as segment:
+        segment.write(b"\x01\x02\x03\x04\x05")
+
+    log = MessageLog(str(tmp_path))
+    assert log.next_id == 3
+    assert os.path.getsize(path) == size
+    assert post(log, 1, start=2) == [3]
+    assert log.get(3).text == "message 2"
+    log.close()